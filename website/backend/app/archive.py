@@ -0,0 +1,222 @@
+import gzip
+import os
+import tarfile
+import time
+import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Iterator
+
+import zstandard
+
+CHUNK_SIZE = 1024 * 1024
+
+# format -> (media type, file extension, allowed compression levels, default level)
+ARCHIVE_FORMATS = {
+    "zip": ("application/zip", ".zip", range(0, 10), 6),
+    "tar.gz": ("application/gzip", ".tar.gz", range(0, 10), 6),
+    "tar.zst": ("application/zstd", ".tar.zst", range(1, 20), 3),
+}
+
+# Members with these extensions are already compressed; deflating them again
+# costs CPU and saves next to nothing, so zip archives store them as is
+COMPRESSED_EXTENSIONS = {
+    ".7z", ".apk", ".avif", ".br", ".bz2", ".docx", ".ear", ".gif", ".gz", ".heic",
+    ".jar", ".jpeg", ".jpg", ".lz4", ".m4a", ".mkv", ".mov", ".mp3", ".mp4", ".odt",
+    ".ogg", ".png", ".pptx", ".rar", ".tgz", ".war", ".webm", ".webp", ".whl",
+    ".woff", ".woff2", ".xlsx", ".xz", ".zip", ".zst",
+}
+
+# tar.gz archives are compressed as a series of independent gzip members of this
+# size, which any gzip reader decompresses as a single stream
+GZIP_BLOCK_SIZE = 4 * 1024 * 1024
+
+# Compression threads shared by all concurrent pulls, so they can't multiply
+# with the number of requests; each tar.zst stream gets ZSTD_THREADS of its own
+ARCHIVE_WORKERS = min(4, os.cpu_count() or 1)
+ZSTD_THREADS = 2
+_gzip_pool = ThreadPoolExecutor(max_workers=ARCHIVE_WORKERS, thread_name_prefix="archive-gzip")
+
+
+class _StreamSink:
+    """
+    Write-only file object for zipfile. It has no seek(), so zipfile writes
+    data descriptors instead of rewinding, and written bytes can be handed to
+    the response as soon as they are produced.
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._position = 0
+
+    def write(self, data: bytes) -> int:
+        self._buffer += data
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def flush(self) -> None:
+        pass
+
+    @property
+    def pending(self) -> int:
+        # Not __len__: zipfile checks the truthiness of its file object
+        return len(self._buffer)
+
+    def take(self) -> bytes:
+        data = bytes(self._buffer)
+        self._buffer.clear()
+        return data
+
+
+def is_compressed(path: str) -> bool:
+    return os.path.splitext(path)[1].lower() in COMPRESSED_EXTENSIONS
+
+
+def stream_zip(files: Iterable[tuple[str, str]], extra: Iterable[tuple[str, bytes]] = (), level: int | None = None) -> Iterator[bytes]:
+    """
+    Yields a zip archive of (arcname, path) files, then of in-memory (arcname, data)
+    members, chunk by chunk. Memory use is bounded by CHUNK_SIZE plus the
+    compressor's window. Files that vanish before they are read are skipped.
+    """
+    sink = _StreamSink()
+    with zipfile.ZipFile(sink, "w", zipfile.ZIP_DEFLATED, compresslevel=level) as zipf:
+        for arcname, path in files:
+            try:
+                src = open(path, "rb")
+            except FileNotFoundError:
+                continue
+
+            with src:
+                stat = os.fstat(src.fileno())
+                zinfo = zipfile.ZipInfo(arcname, time.localtime(stat.st_mtime)[:6])
+                zinfo.external_attr = (stat.st_mode & 0xFFFF) << 16
+                zinfo.file_size = stat.st_size
+                if is_compressed(arcname):
+                    zinfo.compress_type = zipfile.ZIP_STORED
+                else:
+                    zinfo.compress_type = zipfile.ZIP_DEFLATED
+                    # zipf.open() takes the level from the ZipInfo, not the ZipFile
+                    zinfo._compresslevel = level
+
+                with zipf.open(zinfo, "w") as dest:
+                    while chunk := src.read(CHUNK_SIZE):
+                        dest.write(chunk)
+                        if sink.pending >= CHUNK_SIZE:
+                            yield sink.take()
+            if sink.pending:
+                yield sink.take()
+
+        for arcname, data in extra:
+            zipf.writestr(arcname, data)
+
+    yield sink.take()
+
+
+def _tar_padding(size: int) -> bytes:
+    return bytes(-size % tarfile.BLOCKSIZE)
+
+
+def stream_tar(files: Iterable[tuple[str, str]], extra: Iterable[tuple[str, bytes]] = ()) -> Iterator[bytes]:
+    """
+    Yields an uncompressed tar stream of (arcname, path) files, then of in-memory
+    (arcname, data) members. Headers are built directly rather than through
+    tarfile.addfile(), which would copy each file whole before returning.
+    """
+    for _, chunk in _tar_chunks(files, extra):
+        yield chunk
+
+
+def _tar_chunks(files: Iterable[tuple[str, str]], extra: Iterable[tuple[str, bytes]]) -> Iterator[tuple[bool, bytes]]:
+    """The tar stream as (chunk belongs to an already-compressed member, chunk) pairs."""
+    written = 0
+    for arcname, path in files:
+        try:
+            src = open(path, "rb")
+        except FileNotFoundError:
+            continue
+
+        with src:
+            stat = os.fstat(src.fileno())
+            info = tarfile.TarInfo(arcname)
+            info.size = stat.st_size
+            info.mtime = int(stat.st_mtime)
+            info.mode = stat.st_mode & 0o7777
+            header = info.tobuf(tarfile.PAX_FORMAT)
+            stored = is_compressed(arcname)
+            yield stored, header
+
+            # Working tree files are replaced, never written in place, so the open
+            # file keeps the size recorded in the header
+            remaining = info.size
+            while remaining > 0 and (chunk := src.read(min(CHUNK_SIZE, remaining))):
+                remaining -= len(chunk)
+                yield stored, chunk
+            yield stored, bytes(remaining) + _tar_padding(info.size)
+            written += len(header) + info.size + len(_tar_padding(info.size))
+
+    for arcname, data in extra:
+        info = tarfile.TarInfo(arcname)
+        info.size = len(data)
+        info.mtime = int(time.time())
+        member = info.tobuf(tarfile.PAX_FORMAT) + data + _tar_padding(len(data))
+        yield False, member
+        written += len(member)
+
+    # End-of-archive marker, padded to a whole record like tarfile does
+    written += 2 * tarfile.BLOCKSIZE
+    yield False, bytes(2 * tarfile.BLOCKSIZE + (-written % tarfile.RECORDSIZE))
+
+
+def stream_tar_gz(files: Iterable[tuple[str, str]], extra: Iterable[tuple[str, bytes]] = (), level: int | None = None) -> Iterator[bytes]:
+    """
+    Yields a gzip-compressed tar stream. Blocks of GZIP_BLOCK_SIZE are compressed
+    concurrently on the shared pool (zlib releases the GIL) and emitted in order.
+    A block also ends where members switch between compressible and already
+    compressed ones, so the latter can be stored at level 0 like zip does.
+    """
+    level = ARCHIVE_FORMATS["tar.gz"][3] if level is None else level
+    pending = deque()
+    block = bytearray()
+    block_stored = False
+
+    def submit_block() -> None:
+        pending.append(_gzip_pool.submit(gzip.compress, bytes(block), 0 if block_stored else level, mtime=0))
+        block.clear()
+
+    for stored, chunk in _tar_chunks(files, extra):
+        if stored != block_stored and block:
+            submit_block()
+        block_stored = stored
+        block += chunk
+        if len(block) >= GZIP_BLOCK_SIZE:
+            submit_block()
+        # Keep the workers busy while bounding the blocks held in memory
+        while len(pending) > ARCHIVE_WORKERS or (pending and pending[0].done()):
+            yield pending.popleft().result()
+
+    if block or not pending:
+        submit_block()
+    while pending:
+        yield pending.popleft().result()
+
+
+def stream_tar_zst(files: Iterable[tuple[str, str]], extra: Iterable[tuple[str, bytes]] = (), level: int | None = None) -> Iterator[bytes]:
+    """Yields a zstd-compressed tar stream, compressed by ZSTD_THREADS of zstd's own worker threads."""
+    level = ARCHIVE_FORMATS["tar.zst"][3] if level is None else level
+    compressor = zstandard.ZstdCompressor(level=level, threads=ZSTD_THREADS).compressobj()
+    for chunk in stream_tar(files, extra):
+        if out := compressor.compress(chunk):
+            yield out
+    yield compressor.flush()
+
+
+def stream_archive(archive_format: str, files: Iterable[tuple[str, str]], extra: Iterable[tuple[str, bytes]] = (), level: int | None = None) -> Iterator[bytes]:
+    """Streams files in one of ARCHIVE_FORMATS."""
+    if archive_format == "tar.gz":
+        return stream_tar_gz(files, extra, level)
+    if archive_format == "tar.zst":
+        return stream_tar_zst(files, extra, level)
+    return stream_zip(files, extra, level)
@@ -0,0 +1,101 @@
+import hashlib
+import os
+from typing import Iterable, Iterator
+
+from .storage import STORAGE_ROOT, new_temp_path
+
+PULL_CACHE_DIR = os.path.join(STORAGE_ROOT, "cache", "pulls")
+
+# Total size the cached pull archives may use; least recently served entries are
+# evicted first. 0 disables the cache.
+PULL_CACHE_MAX_BYTES = int(os.getenv("PULL_CACHE_MAX_BYTES", str(1024 * 1024 * 1024)))
+
+
+def archive_key(project_id: int, version: str) -> str:
+    # Entries are prefixed with the project id so a project's entries can be dropped together
+    return f"{project_id}-{hashlib.sha256(version.encode()).hexdigest()[:32]}"
+
+
+def _entry_path(key: str) -> str:
+    return os.path.join(PULL_CACHE_DIR, key)
+
+
+def get_cached_archive(key: str) -> str | None:
+    """Returns the path of a cached archive, marking it as recently used, or None."""
+    if PULL_CACHE_MAX_BYTES <= 0:
+        return None
+    path = _entry_path(key)
+    try:
+        # The mtime doubles as the LRU timestamp
+        os.utime(path)
+    except FileNotFoundError:
+        return None
+    return path
+
+
+def cache_archive_stream(key: str, chunks: Iterable[bytes]) -> Iterator[bytes]:
+    """
+    Passes an archive stream through while writing it to a temp file. The entry
+    is only stored once the stream completes, so an aborted download never
+    leaves a truncated archive behind.
+    """
+    if PULL_CACHE_MAX_BYTES <= 0:
+        yield from chunks
+        return
+
+    tmp_path = new_temp_path()
+    f = open(tmp_path, "wb")
+    try:
+        for chunk in chunks:
+            f.write(chunk)
+            yield chunk
+        size = f.tell()
+        f.close()
+        if size <= PULL_CACHE_MAX_BYTES:
+            os.makedirs(PULL_CACHE_DIR, exist_ok=True)
+            os.replace(tmp_path, _entry_path(key))
+            evict_archives()
+    finally:
+        f.close()
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def evict_archives() -> None:
+    """Removes the least recently used entries until the cache fits PULL_CACHE_MAX_BYTES."""
+    entries = []
+    try:
+        with os.scandir(PULL_CACHE_DIR) as it:
+            for entry in it:
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+    except FileNotFoundError:
+        return
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= PULL_CACHE_MAX_BYTES:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+def invalidate_project_archives(project_id: int) -> None:
+    """Drops every cached archive of a project."""
+    prefix = f"{project_id}-"
+    try:
+        with os.scandir(PULL_CACHE_DIR) as it:
+            for entry in it:
+                if entry.name.startswith(prefix):
+                    try:
+                        os.remove(entry.path)
+                    except FileNotFoundError:
+                        pass
+    except FileNotFoundError:
+        pass
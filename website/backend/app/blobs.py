@@ -0,0 +1,89 @@
+import os
+from datetime import datetime, timedelta, timezone
+from typing import Iterable
+from sqlalchemy import delete, select, text, tuple_
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+from .database import SessionLocal, engine
+from .models import FileRecord, ManifestEntry, DeploymentFile, BlobSweep
+from .manifest import BATCH_SIZE
+from .precompress import ENCODINGS, variant_path
+from .storage import is_sha256, remove_unused_blob
+
+# Seconds a queued blob waits before it is checked, so a push that found it
+# stored just before it was queued has linked it by then
+BLOB_SWEEP_DELAY = float(os.getenv("BLOB_SWEEP_DELAY", "600"))
+
+# Advisory lock that lets a single worker sweep; the reaper and consistency check use classes 1 and 2
+BLOB_SWEEP_LOCK_CLASS = 3
+
+
+def queue_blob_sweeps(db: Session, hashes: Iterable[str]) -> None:
+    """
+    Queues blobs that may no longer be used, e.g. those of a deleted project,
+    for sweep_blobs. Call it after the links being dropped are gone: a blob
+    linked or reused after it was queued is kept. Runs in the caller's transaction.
+    """
+    now = datetime.utcnow()
+    rows = [{"hash": digest, "queued_at": now} for digest in set(hashes) if is_sha256(digest)]
+    for start in range(0, len(rows), BATCH_SIZE):
+        statement = insert(BlobSweep).values(rows[start:start + BATCH_SIZE])
+        db.execute(statement.on_conflict_do_update(
+            index_elements=[BlobSweep.hash],
+            set_={"queued_at": statement.excluded.queued_at}
+        ))
+
+
+def _referenced(db: Session, hashes: list[str]) -> set[str]:
+    referenced = set()
+    for column in (FileRecord.hash, ManifestEntry.hash, DeploymentFile.hash):
+        referenced.update(db.scalars(select(column).where(column.in_(hashes)).distinct()))
+    return referenced
+
+
+def sweep_blobs() -> int:
+    """
+    Removes queued blobs once BLOB_SWEEP_DELAY has passed, if no file record,
+    manifest entry or deployment file names them and nothing links to them.
+    Removal happens under the blob's exclusive lock, and storing or reusing a
+    blob takes its shared lock, so a concurrent push can't link a blob that is
+    being removed. Returns how many blobs it removed.
+    """
+    removed = 0
+    with engine.connect() as lock_conn:
+        locked = lock_conn.scalar(text("SELECT pg_try_advisory_lock(:class, 0)"), {"class": BLOB_SWEEP_LOCK_CLASS})
+        lock_conn.commit()
+        if not locked:
+            return 0
+        db = SessionLocal()
+        try:
+            while True:
+                due = db.execute(
+                    select(BlobSweep.hash, BlobSweep.queued_at)
+                    .where(BlobSweep.queued_at <= datetime.utcnow() - timedelta(seconds=BLOB_SWEEP_DELAY))
+                    .order_by(BlobSweep.queued_at)
+                    .limit(BATCH_SIZE)
+                ).all()
+                if not due:
+                    break
+
+                referenced = _referenced(db, [digest for digest, _ in due])
+                for digest, queued_at in due:
+                    if digest in referenced:
+                        continue
+                    if remove_unused_blob(digest, queued_at.replace(tzinfo=timezone.utc).timestamp()):
+                        removed += 1
+                        for encoding in ENCODINGS:
+                            try:
+                                os.remove(variant_path(digest, encoding))
+                            except FileNotFoundError:
+                                pass
+
+                # Rows queued again meanwhile stay for their own turn
+                db.execute(delete(BlobSweep).where(tuple_(BlobSweep.hash, BlobSweep.queued_at).in_(due)))
+                db.commit()
+        finally:
+            db.close()
+            lock_conn.execute(text("SELECT pg_advisory_unlock(:class, 0)"), {"class": BLOB_SWEEP_LOCK_CLASS})
+            lock_conn.commit()
+    return removed
@@ -0,0 +1,115 @@
+import asyncio
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable
+
+# How long a worker may serve a cached head before re-reading it. Pushes handled
+# by the same worker invalidate immediately; this bounds staleness across workers.
+HEAD_CACHE_TTL = float(os.getenv("HEAD_CACHE_TTL", "5"))
+
+# Same bound for deployed sites resolved by /pages. Deploys, undeploys and rollbacks
+# handled by the same worker invalidate the live site immediately.
+PAGES_CACHE_TTL = float(os.getenv("PAGES_CACHE_TTL", "5"))
+
+_MISSING = object()
+
+
+class TTLCache:
+    """
+    Small thread-safe in-process cache. Entries expire ttl seconds after they
+    were set; once max_entries is reached the least recently used is dropped.
+    """
+
+    def __init__(self, ttl: float, max_entries: int = 10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._entries.get(key, _MISSING)
+            if entry is _MISSING:
+                return default
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key: Hashable) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+class ChangeNotifier:
+    """
+    Lets async handlers wait until a key changes. notify() may be called from
+    any thread, including the threadpool that runs sync handlers.
+    """
+
+    def __init__(self):
+        self._waiters: dict[Hashable, set] = {}
+        self._lock = threading.Lock()
+
+    async def wait(self, key: Hashable, timeout: float) -> bool:
+        """Returns True if key was notified within timeout seconds."""
+        waiter = (asyncio.get_running_loop(), asyncio.Event())
+        with self._lock:
+            self._waiters.setdefault(key, set()).add(waiter)
+        try:
+            await asyncio.wait_for(waiter[1].wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            with self._lock:
+                waiters = self._waiters.get(key)
+                if waiters is not None:
+                    waiters.discard(waiter)
+                    if not waiters:
+                        del self._waiters[key]
+
+    def notify(self, key: Hashable) -> None:
+        with self._lock:
+            waiters = list(self._waiters.get(key, ()))
+        for loop, event in waiters:
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError:
+                # The waiter's loop has shut down
+                pass
+
+
+# Head commit of each project by (username, project_name), as served by fetch
+head_cache = TTLCache(HEAD_CACHE_TTL)
+head_changes = ChangeNotifier()
+
+
+def head_changed(username: str, project_name: str) -> None:
+    """Called after a push lands so fetch stops serving, and stops waiting on, the old head."""
+    head_cache.invalidate((username, project_name))
+    head_changes.notify((username, project_name))
+
+
+# Deployment served by /pages by (username, project_name, snapshot_id), where a
+# snapshot_id of None is the live deployment
+page_sites = TTLCache(PAGES_CACHE_TTL)
+# Files of each deployment by deployment id. Deployments never change, so entries
+# only expire to bound memory.
+page_assets = TTLCache(3600, max_entries=100)
+
+
+def deployment_changed(username: str, project_name: str) -> None:
+    """Called after a deploy, undeploy or rollback so /pages re-resolves the live site."""
+    page_sites.invalidate((username, project_name, None))
@@ -1,74 +1,152 @@
 import os
+import json
 import time
-from sqlalchemy.orm import Session
-from .models import Project, FileRecord, Commit, User, Star, RepoDetails
+from datetime import datetime, timedelta
+from typing import Optional
+from sqlalchemy import delete, exists, or_, select, text
+from sqlalchemy.orm import Session, aliased
+from .database import SessionLocal, engine
+from .models import Project, FileRecord, Commit, User, ConsistencyRun
+from .manifest import BATCH_SIZE
+from .reaper import tombstone_project
+from .storage import OBJECTS_DIR
 
-LAST_CHECK_FILE = "temp/last_consistency_check.txt"
-CHECK_COOLDOWN = 600  # 10 minutes
+# Minimum time between checks across all workers
+CONSISTENCY_INTERVAL = float(os.getenv("CONSISTENCY_INTERVAL", "600"))
 
-def run_consistency_check_if_needed(db: Session):
+# How often each worker asks whether a check is due
+CONSISTENCY_POLL_INTERVAL = 60
+
+# Advisory lock that lets a single worker run the check; the reaper uses class 1
+CONSISTENCY_LOCK_CLASS = 2
+
+MAX_FINDINGS = 100
+
+
+def run_consistency_check_if_due() -> Optional[int]:
     """
-    Runs the consistency check only if the cooldown period has passed.
+    Runs verify_and_cleanup_db when CONSISTENCY_INTERVAL has passed since the
+    last run started. An advisory lock makes it single-flight across workers.
+    Returns the id of the run, or None if no check was due or another worker
+    holds the lock.
     """
-    now = time.time()
-    should_check = True
-    if os.path.exists(LAST_CHECK_FILE):
+    with engine.connect() as lock_conn:
+        locked = lock_conn.scalar(text("SELECT pg_try_advisory_lock(:class, 0)"), {"class": CONSISTENCY_LOCK_CLASS})
+        lock_conn.commit()
+        if not locked:
+            return None
+        db = SessionLocal()
         try:
-            with open(LAST_CHECK_FILE, "r") as f:
-                last_check = float(f.read().strip())
-            if now - last_check < CHECK_COOLDOWN:
-                should_check = False
-        except:
-            pass
-            
-    if should_check:
-        verify_and_cleanup_db(db)
-        try:
-            os.makedirs("temp", exist_ok=True)
-            with open(LAST_CHECK_FILE, "w") as f:
-                f.write(str(now))
-        except:
-            pass
+            last_run = db.scalar(select(ConsistencyRun).order_by(ConsistencyRun.started_at.desc()).limit(1))
+            if last_run and last_run.started_at > datetime.utcnow() - timedelta(seconds=CONSISTENCY_INTERVAL):
+                return None
+
+            # Anything updated after the last successful run started is checked again
+            last_success = db.scalar(
+                select(ConsistencyRun.started_at)
+                .where(ConsistencyRun.finished_at.is_not(None), ConsistencyRun.error.is_(None))
+                .order_by(ConsistencyRun.started_at.desc())
+                .limit(1)
+            )
+            run = ConsistencyRun(started_at=datetime.utcnow(), checked_since=last_success)
+            db.add(run)
+            db.commit()
+
+            started = time.monotonic()
+            try:
+                verify_and_cleanup_db(db, run)
+            except Exception as e:
+                db.rollback()
+                print(f"Error running consistency check: {e}")
+                run.error = str(e)
+            run.finished_at = datetime.utcnow()
+            run.duration_ms = int((time.monotonic() - started) * 1000)
+            db.commit()
+            return run.id
+        finally:
+            db.close()
+            lock_conn.execute(text("SELECT pg_advisory_unlock(:class, 0)"), {"class": CONSISTENCY_LOCK_CLASS})
+            lock_conn.commit()
+
 
-def verify_and_cleanup_db(db: Session):
+def _record(run: ConsistencyRun, findings: list, message: str) -> None:
+    print(message)
+    if len(findings) < MAX_FINDINGS:
+        findings.append(message)
+        run.findings = json.dumps(findings)
+
+
+def verify_and_cleanup_db(db: Session, run: ConsistencyRun):
     """
-    Checks if files and projects in the database actually exist on disk.
-    If not, cleans up the database records to maintain consistency.
+    Checks that projects updated since run.checked_since, and the files recorded
+    for them since then, actually exist on disk. Projects whose directory is
+    gone are tombstoned for the reaper; records of missing files are removed.
+    Projects are processed BATCH_SIZE at a time, each batch in its own transaction.
     """
     print("Running database-to-filesystem consistency check...")
-    
-    # 1. Check Projects
-    projects = db.query(Project).all()
-    for project in projects:
-        owner = db.query(User).filter(User.id == project.user_id).first()
-        if not owner:
-            # Orphaned project, should probably be removed
-            print(f"Removing orphaned project: {project.project_name} (No owner)")
-            db.delete(project)
-            continue
-            
-        project_dir = os.path.join("storage", "files", owner.username, project.project_name)
-        if not os.path.exists(project_dir):
-            print(f"Project directory missing for {owner.username}/{project.project_name}. Cleaning up DB records.")
-
-            # Delete dependent records first to avoid IntegrityError
-            db.query(Star).filter(Star.project_id == project.id).delete()
-            db.query(RepoDetails).filter(RepoDetails.project_id == project.id).delete()
-            db.query(FileRecord).filter(FileRecord.commit_id.in_(
-                db.query(Commit.commit_id).filter(Commit.project_id == project.id)
-            )).delete(synchronize_session=False)
-            db.query(Commit).filter(Commit.project_id == project.id).delete()
-            db.delete(project)
-            continue
-
-        file_records = db.query(FileRecord).filter(FileRecord.commit_id.in_(
-            db.query(Commit.commit_id).filter(Commit.project_id == project.id)
-        )).all()
-        
-        for record in file_records:
-            if not os.path.exists(record.storage_path):
-                print(f"File missing on disk: {record.storage_path}. Removing DB record.")
-                db.delete(record)
-
-    db.commit()
+    since = run.checked_since
+    findings = json.loads(run.findings or "[]")
+    after_id = 0
+
+    while True:
+        query = (
+            select(Project, User.username)
+            .outerjoin(User, User.id == Project.user_id)
+            .where(Project.deleted_at.is_(None), Project.id > after_id)
+            .order_by(Project.id)
+            .limit(BATCH_SIZE)
+        )
+        if since:
+            query = query.where(Project.last_updated > since)
+        batch = db.execute(query).all()
+        if not batch:
+            break
+        after_id = batch[-1][0].id
+
+        present = []
+        for project, username in batch:
+            if not username:
+                _record(run, findings, f"Removing orphaned project: {project.project_name} (No owner)")
+            elif not os.path.exists(os.path.join("storage", "files", username, project.project_name)):
+                _record(run, findings, f"Project directory missing for {username}/{project.project_name}. Cleaning up DB records.")
+            else:
+                present.append(project.id)
+                continue
+            tombstone_project(db, project, username)
+            run.projects_removed += 1
+        run.projects_checked += len(batch)
+
+        # Legacy records point into the working tree; once a later push supersedes
+        # the file, its content lives under .history and the path is expected to be gone
+        later = aliased(FileRecord)
+        later_commit = aliased(Commit)
+        superseded = exists().where(
+            later_commit.commit_id == later.commit_id,
+            later_commit.project_id == Commit.project_id,
+            later.path == FileRecord.path,
+            later.id > FileRecord.id
+        )
+        records = select(FileRecord.id, FileRecord.storage_path).join(
+            Commit, Commit.commit_id == FileRecord.commit_id
+        ).where(
+            Commit.project_id.in_(present),
+            # Deletion records keep the path the file was moved out of
+            FileRecord.hash != "DELETED",
+            or_(FileRecord.storage_path.startswith(OBJECTS_DIR + "/"), ~superseded)
+        )
+        if since:
+            records = records.where(FileRecord.created_at > since)
+
+        missing = []
+        for record_id, storage_path in db.execute(records):
+            run.files_checked += 1
+            if not os.path.exists(storage_path):
+                _record(run, findings, f"File missing on disk: {storage_path}. Removing DB record.")
+                missing.append(record_id)
+        for start in range(0, len(missing), BATCH_SIZE):
+            db.execute(delete(FileRecord).where(FileRecord.id.in_(missing[start:start + BATCH_SIZE])))
+        run.file_records_removed += len(missing)
+
+        db.commit()
+
     print("Consistency check completed.")
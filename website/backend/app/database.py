@@ -1,8 +1,10 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
 from sqlalchemy.orm import sessionmaker, declarative_base
 import os
 from dotenv import load_dotenv
-from typing import Generator
+from typing import AsyncGenerator, Generator
 
 load_dotenv()
 
@@ -13,6 +15,13 @@ if DATABASE_URL and "+asyncpg" in DATABASE_URL:
 if not DATABASE_URL:
     raise ValueError("DATABASE_URL environment variable is not set")
 
+# Same database through asyncpg, for handlers that must not block the event loop
+_async_url = make_url(DATABASE_URL).set(drivername="postgresql+asyncpg")
+if "sslmode" in _async_url.query:
+    # asyncpg calls libpq's sslmode "ssl"
+    _async_url = _async_url.update_query_dict({"ssl": _async_url.query["sslmode"]}).difference_update_query(["sslmode"])
+ASYNC_DATABASE_URL = _async_url
+
 # Create engine with psycopg2
 engine = create_engine(
     DATABASE_URL,
@@ -27,6 +36,19 @@ SessionLocal = sessionmaker(
     autoflush=False,
 )
 
+# Create async engine with asyncpg
+async_engine = create_async_engine(
+    ASYNC_DATABASE_URL,
+    echo=True,
+    pool_pre_ping=True,
+)
+
+AsyncSessionLocal = async_sessionmaker(
+    bind=async_engine,
+    autoflush=False,
+    expire_on_commit=False,
+)
+
 Base = declarative_base()
 
 # Dependency to get database session
@@ -37,7 +59,52 @@ def get_db() -> Generator:
     finally:
         db.close()
 
+# Dependency to get an async database session
+async def get_async_db() -> AsyncGenerator[AsyncSession, None]:
+    async with AsyncSessionLocal() as db:
+        yield db
+
 def init_db() -> None:
     """Initialize database and create all tables"""
     Base.metadata.create_all(bind=engine)
+    add_missing_columns()
     print("Database tables created successfully")
+
+# Statements that make existing rows satisfy a unique index, run before it is
+# added to an existing table
+INDEX_PREPARATIONS = {
+    "ix_repo_details_project_id_unique": [
+        # Keep the oldest row of each project, then recount its stars from the
+        # stars table since duplicate rows split (and lost) star updates
+        "DELETE FROM repo_details a USING repo_details b WHERE a.project_id = b.project_id AND a.id > b.id",
+        "UPDATE repo_details r SET stars = (SELECT count(*) FROM stars s WHERE s.project_id = r.project_id)",
+    ],
+}
+
+def add_missing_columns() -> None:
+    """
+    create_all() skips tables that already exist, so columns and indexes added
+    to existing models are created here. Added columns must be nullable or
+    have a server_default.
+    """
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                ddl = f'ALTER TABLE {table.name} ADD COLUMN IF NOT EXISTS "{column.name}" {column.type.compile(dialect=engine.dialect)}'
+                if column.server_default is not None:
+                    default = column.server_default.arg
+                    # text() defaults are SQL; plain strings are literals
+                    ddl += " DEFAULT " + (default.text if hasattr(default, "text") else "'" + str(default).replace("'", "''") + "'")
+                conn.execute(text(ddl))
+                print(f"Added column {table.name}.{column.name}")
+            existing_indexes = {index["name"] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name in existing_indexes:
+                    continue
+                for statement in INDEX_PREPARATIONS.get(index.name, []):
+                    conn.execute(text(statement))
+                index.create(conn, checkfirst=True)
@@ -1,6 +1,9 @@
 from fastapi import Header, HTTPException, Depends
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-from .database import get_db
+from typing import Optional
+from .database import get_db, get_async_db
 from .models import User
 
 # Dependency to authenticate user
@@ -15,3 +18,26 @@ def get_current_user(authorization: str = Header(None), db: Session = Depends(ge
         raise HTTPException(status_code=401, detail="Invalid API key")
     
     return user
+
+
+# Same as get_current_user, for handlers running on an AsyncSession
+async def get_current_user_async(authorization: str = Header(None), db: AsyncSession = Depends(get_async_db)) -> User:
+    if not authorization or not authorization.startswith("Bearer "):
+        raise HTTPException(status_code=401, detail="Missing or invalid authorization header")
+    
+    token = authorization.replace("Bearer ", "").strip()
+    user = await db.scalar(select(User).where(User.api_key == token))
+    
+    if not user:
+        raise HTTPException(status_code=401, detail="Invalid API key")
+    
+    return user
+
+
+# For endpoints that anyone may call but that add per-user details for signed-in callers
+def get_optional_user(authorization: str = Header(None), db: Session = Depends(get_db)) -> Optional[User]:
+    if not authorization or not authorization.startswith("Bearer "):
+        return None
+    
+    token = authorization.replace("Bearer ", "").strip()
+    return db.query(User).filter(User.api_key == token).first()
@@ -0,0 +1,141 @@
+import os
+import shutil
+import hashlib
+from typing import Iterable, Optional
+from sqlalchemy import delete, select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+from .models import Project, ProjectHead, ManifestEntry, RepoDetails, Deployment, DeploymentFile
+from .manifest import BATCH_SIZE, ensure_manifest
+from .blobs import queue_blob_sweeps
+from .storage import STORAGE_ROOT, checkout_blob, has_blob, new_temp_path, project_storage_dir, store_blob_from_path
+
+# Deployments kept per project for rollback, besides the active one
+DEPLOYMENT_HISTORY = int(os.getenv("DEPLOYMENT_HISTORY", "20"))
+
+DEPLOYMENTS_DIR = os.path.join(STORAGE_ROOT, "deployments")
+
+
+def _snapshot_id(source_path: str, files: list[tuple[str, str, int]]) -> str:
+    hasher = hashlib.sha256(source_path.encode() + b"\n")
+    for path, digest, _ in files:
+        hasher.update(f"{path}\0{digest}\n".encode())
+    return hasher.hexdigest()
+
+
+def _store_working_file(project_dir: str, path: str) -> Optional[tuple[str, int]]:
+    """Adds a file pushed before the object store existed to it. Returns (sha256, size), or None if it is gone."""
+    tmp_path = new_temp_path()
+    try:
+        shutil.copyfile(os.path.join(project_dir, path), tmp_path)
+    except FileNotFoundError:
+        return None
+    return store_blob_from_path(tmp_path)
+
+
+def create_deployment(db: Session, project: Project, source_path: str) -> Optional[Deployment]:
+    """
+    Snapshots the project's head tree as a Deployment without making it live.
+    Files are recorded by hash, so nothing is copied and later pushes can't
+    change the snapshot. Deploying a tree that was deployed before returns the
+    existing snapshot. Returns None if source_path is not in the tree. Runs in
+    the caller's transaction.
+    """
+    ensure_manifest(db, project)
+    # A push can't change the tree while it is read
+    head = db.execute(select(ProjectHead).where(ProjectHead.project_id == project.id).with_for_update()).scalar_one()
+    entries = db.execute(
+        select(ManifestEntry.path, ManifestEntry.hash, ManifestEntry.size)
+        .where(ManifestEntry.project_id == project.id)
+        .order_by(ManifestEntry.path)
+    ).all()
+    if source_path not in {path for path, _, _ in entries}:
+        return None
+
+    project_dir = project_storage_dir(project.user.username, project.project_name)
+    files = []
+    for path, digest, size in entries:
+        if not has_blob(digest):
+            stored = _store_working_file(project_dir, path)
+            if not stored:
+                continue
+            digest, size = stored
+        files.append((path, digest, size))
+
+    snapshot_id = _snapshot_id(source_path, files)
+    deployment = db.scalar(select(Deployment).where(
+        Deployment.project_id == project.id,
+        Deployment.snapshot_id == snapshot_id
+    ))
+    if deployment:
+        return deployment
+
+    deployment = Deployment(
+        project_id=project.id,
+        snapshot_id=snapshot_id,
+        commit_id=head.commit_id,
+        source_path=source_path,
+        file_count=len(files),
+        size=sum(size for _, _, size in files)
+    )
+    db.add(deployment)
+    db.flush()
+
+    rows = [{"deployment_id": deployment.id, "path": path, "hash": digest, "size": size} for path, digest, size in files]
+    for start in range(0, len(rows), BATCH_SIZE):
+        db.execute(insert(DeploymentFile), rows[start:start + BATCH_SIZE])
+    return deployment
+
+
+def deployment_dir(deployment_id: int) -> str:
+    return os.path.join(DEPLOYMENTS_DIR, str(deployment_id))
+
+
+def link_deployment(deployment_id: int, files: Iterable[tuple[str, str, int]]) -> None:
+    """
+    Hardlinks every blob of a committed deployment's (path, hash, size) files
+    under deployment_dir. The extra link keeps compaction from packing a blob
+    once a push supersedes it, so pages keep serving deployed files raw.
+    """
+    directory = deployment_dir(deployment_id)
+    for digest in {digest for _, digest, _ in files}:
+        dest = os.path.join(directory, digest)
+        if not os.path.exists(dest) and has_blob(digest):
+            checkout_blob(digest, dest)
+
+
+def activate_deployment(db: Session, project_id: int, deployment: Deployment) -> None:
+    """Makes deployment the live site of the project in a single statement. Runs in the caller's transaction."""
+    values = {
+        "isDeployed": True,
+        "deploy_source_path": deployment.source_path,
+        "deployment_id": deployment.id,
+    }
+    db.execute(
+        insert(RepoDetails)
+        .values(project_id=project_id, **values)
+        .on_conflict_do_update(index_elements=[RepoDetails.project_id], set_=values)
+    )
+
+
+def prune_deployments(db: Session, project_id: int) -> None:
+    """Drops all but the newest DEPLOYMENT_HISTORY deployments; the active one is always kept."""
+    active = select(RepoDetails.deployment_id).where(
+        RepoDetails.project_id == project_id,
+        RepoDetails.deployment_id.is_not(None)
+    )
+    stale = db.scalars(
+        select(Deployment.id)
+        .where(Deployment.project_id == project_id, Deployment.id.not_in(active))
+        .order_by(Deployment.created_at.desc(), Deployment.id.desc())
+        .offset(DEPLOYMENT_HISTORY)
+    ).all()
+    if stale:
+        for deployment_id in stale:
+            shutil.rmtree(deployment_dir(deployment_id), ignore_errors=True)
+        hashes = db.scalars(
+            delete(DeploymentFile).where(DeploymentFile.deployment_id.in_(stale)).returning(DeploymentFile.hash)
+        ).all()
+        db.execute(delete(Deployment).where(Deployment.id.in_(stale)))
+        queue_blob_sweeps(db, hashes)
+
@@ -0,0 +1,112 @@
+import uuid
+import hashlib
+from datetime import datetime
+from sqlalchemy import String, case, cast, func, insert, literal, select
+from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy.orm import Session
+from .models import Project, Commit, FileRecord, ManifestEntry, ManifestDirectory, ProjectHead, LanguageStat
+from .manifest import ensure_manifest, ensure_directories, ensure_language_stats
+
+
+def fork_commit_id(fork_project_id: int, commit_id: str) -> str:
+    """
+    Id of a commit's copy in a fork. Commit ids are unique across projects, so
+    copies get a UUID derived from the fork and the original id; fork_commit_id_sql
+    computes the same value in the database.
+    """
+    return str(uuid.UUID(hashlib.md5(f"{fork_project_id}:{commit_id}".encode()).hexdigest()))
+
+
+def fork_commit_id_sql(fork_project_id: int, column):
+    return cast(cast(func.md5(literal(f"{fork_project_id}:") + column), UUID), String)
+
+
+def copy_project_records(db: Session, original: Project, fork: Project, original_dir: str, fork_dir: str) -> dict[str, str]:
+    """
+    Copies a project's commits, file records, manifest, directory and language
+    aggregates and head to fork with INSERT ... SELECT statements, so no rows
+    pass through Python. Returns {original commit id: fork commit id}. Runs in
+    the caller's transaction.
+    """
+    ensure_manifest(db, original)
+    # A push to the original can't land halfway through the copy
+    db.execute(select(ProjectHead.project_id).where(ProjectHead.project_id == original.id).with_for_update())
+    ensure_directories(db, original)
+    ensure_language_stats(db, original)
+
+    db.execute(insert(Commit).from_select(
+        ["commit_id", "project_id", "commit_message", "author", "created_at"],
+        select(
+            fork_commit_id_sql(fork.id, Commit.commit_id),
+            literal(fork.id),
+            Commit.commit_message,
+            Commit.author,
+            Commit.created_at
+        ).where(Commit.project_id == original.id)
+    ))
+
+    # Files recorded before the object store point into the project directory
+    prefix = original_dir + "/"
+    storage_path = case(
+        (func.left(FileRecord.storage_path, len(prefix)) == prefix,
+         literal(fork_dir + "/") + func.substr(FileRecord.storage_path, len(prefix) + 1)),
+        else_=FileRecord.storage_path
+    )
+    db.execute(insert(FileRecord).from_select(
+        ["commit_id", "path", "hash", "last_updated", "storage_path", "file_size", "created_at"],
+        select(
+            fork_commit_id_sql(fork.id, FileRecord.commit_id),
+            FileRecord.path,
+            FileRecord.hash,
+            FileRecord.last_updated,
+            storage_path,
+            FileRecord.file_size,
+            FileRecord.created_at
+        )
+        .join(Commit, Commit.commit_id == FileRecord.commit_id)
+        .where(Commit.project_id == original.id)
+    ))
+
+    db.execute(insert(ManifestEntry).from_select(
+        ["project_id", "path", "hash", "size", "language", "commit_id", "parent"],
+        select(
+            literal(fork.id),
+            ManifestEntry.path,
+            ManifestEntry.hash,
+            ManifestEntry.size,
+            ManifestEntry.language,
+            fork_commit_id_sql(fork.id, ManifestEntry.commit_id),
+            ManifestEntry.parent
+        ).where(ManifestEntry.project_id == original.id)
+    ))
+
+    db.execute(insert(ManifestDirectory).from_select(
+        ["project_id", "path", "parent", "child_count", "file_count", "size"],
+        select(
+            literal(fork.id),
+            ManifestDirectory.path,
+            ManifestDirectory.parent,
+            ManifestDirectory.child_count,
+            ManifestDirectory.file_count,
+            ManifestDirectory.size
+        ).where(ManifestDirectory.project_id == original.id)
+    ))
+
+    db.execute(insert(LanguageStat).from_select(
+        ["project_id", "language", "bytes"],
+        select(literal(fork.id), LanguageStat.language, LanguageStat.bytes).where(LanguageStat.project_id == original.id)
+    ))
+
+    db.execute(insert(ProjectHead).from_select(
+        ["project_id", "commit_id", "updated_at", "readme_path", "languages_version"],
+        select(
+            literal(fork.id),
+            fork_commit_id_sql(fork.id, ProjectHead.commit_id),
+            literal(datetime.utcnow()),
+            ProjectHead.readme_path,
+            ProjectHead.languages_version
+        ).where(ProjectHead.project_id == original.id)
+    ))
+
+    commit_ids = db.scalars(select(Commit.commit_id).where(Commit.project_id == original.id)).all()
+    return {commit_id: fork_commit_id(fork.id, commit_id) for commit_id in commit_ids}
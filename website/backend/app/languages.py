@@ -0,0 +1,65 @@
+import os
+from typing import Optional
+
+# Bump whenever the maps below change, so stored language stats are rebuilt
+LANGUAGE_MAP_VERSION = 2
+
+LANGUAGE_EXTENSIONS = {
+    '.py': 'Python',
+    '.js': 'JavaScript',
+    '.mjs': 'JavaScript',
+    '.cjs': 'JavaScript',
+    '.jsx': 'JavaScript',
+    '.ts': 'TypeScript',
+    '.tsx': 'TypeScript',
+    '.java': 'Java',
+    '.cpp': 'C++',
+    '.cc': 'C++',
+    '.hpp': 'C++',
+    '.c': 'C',
+    '.h': 'C',
+    '.cs': 'C#',
+    '.rb': 'Ruby',
+    '.go': 'Go',
+    '.php': 'PHP',
+    '.rs': 'Rust',
+    '.swift': 'Swift',
+    '.kt': 'Kotlin',
+    '.m': 'Objective-C',
+    '.html': 'HTML',
+    '.htm': 'HTML',
+    '.css': 'CSS',
+    '.scss': 'SCSS',
+    '.sh': 'Shell',
+    '.bash': 'Shell',
+    '.zsh': 'Shell',
+    '.ps1': 'PowerShell',
+    '.sql': 'SQL',
+    '.lua': 'Lua',
+    '.dart': 'Dart',
+    '.scala': 'Scala',
+    '.hs': 'Haskell',
+    '.ex': 'Elixir',
+    '.exs': 'Elixir',
+    '.zig': 'Zig',
+    '.vue': 'Vue',
+    '.svelte': 'Svelte',
+    '.mk': 'Makefile',
+}
+
+# Files recognised by name rather than extension
+LANGUAGE_FILENAMES = {
+    'Makefile': 'Makefile',
+    'makefile': 'Makefile',
+    'GNUmakefile': 'Makefile',
+    'Dockerfile': 'Dockerfile',
+    'Containerfile': 'Dockerfile',
+}
+
+
+def detect_language(path: str) -> Optional[str]:
+    """Language of a file for repository statistics, or None if it isn't counted."""
+    name = os.path.basename(path)
+    if name in LANGUAGE_FILENAMES:
+        return LANGUAGE_FILENAMES[name]
+    return LANGUAGE_EXTENSIONS.get(os.path.splitext(name)[1].lower())
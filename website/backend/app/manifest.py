@@ -0,0 +1,475 @@
+import os
+import hashlib
+from collections import defaultdict
+from datetime import datetime
+from sqlalchemy import delete, func, select, tuple_, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from .database import SessionLocal
+from .models import Project, Commit, FileRecord, ManifestEntry, ManifestDirectory, ProjectHead, LanguageStat
+from .languages import LANGUAGE_MAP_VERSION, detect_language
+
+BATCH_SIZE = 1000
+
+# Root files shown as the project README, in order of preference
+README_NAMES = ("README.md", "readme.md", "Readme.md")
+
+
+def parent_dir(path: str) -> str:
+    return path.rpartition("/")[0]
+
+
+def _ancestors(path: str) -> list[str]:
+    """Directories containing path, from the root ('') down to its parent."""
+    parts = path.split("/")[:-1]
+    return [""] + ["/".join(parts[:i]) for i in range(1, len(parts) + 1)]
+
+
+def record_file_changes(db: Session, project: Project, commit_id: str, rows: list[dict]) -> None:
+    """
+    Applies pushed FileRecord rows to the project's head manifest and moves
+    its head pointer to commit_id. Runs in the caller's transaction.
+    """
+    ensure_manifest(db, project)
+    # Serializes pushes to a project so directory aggregates are updated from a consistent state
+    db.execute(select(ProjectHead.project_id).where(ProjectHead.project_id == project.id).with_for_update())
+    ensure_directories(db, project)
+    ensure_language_stats(db, project)
+
+    touched = list({row["path"] for row in rows})
+    previous = {}
+    for start in range(0, len(touched), BATCH_SIZE):
+        previous.update(db.execute(
+            select(ManifestEntry.path, ManifestEntry.size).where(
+                ManifestEntry.project_id == project.id,
+                ManifestEntry.path.in_(touched[start:start + BATCH_SIZE])
+            )
+        ).all())
+
+    deleted = [row["path"] for row in rows if row["hash"] == "DELETED"]
+    if deleted:
+        db.execute(delete(ManifestEntry).where(
+            ManifestEntry.project_id == project.id,
+            ManifestEntry.path.in_(deleted)
+        ))
+
+    # Later rows for the same path win
+    changed = {row["path"]: row for row in rows if row["hash"] != "DELETED"}
+    if changed:
+        statement = insert(ManifestEntry)
+        db.execute(
+            statement.on_conflict_do_update(
+                constraint="unique_manifest_project_path",
+                set_={
+                    "hash": statement.excluded.hash,
+                    "size": statement.excluded.size,
+                    "language": statement.excluded.language,
+                    "commit_id": statement.excluded.commit_id,
+                }
+            ),
+            [{
+                "project_id": project.id,
+                "path": path,
+                "hash": row["hash"],
+                "size": row["file_size"],
+                "language": detect_language(path),
+                "commit_id": commit_id,
+                "parent": parent_dir(path),
+            } for path, row in changed.items()]
+        )
+
+    changes = [
+        (path, previous.get(path), changed[path]["file_size"] if path in changed else None)
+        for path in touched
+    ]
+    _apply_directory_changes(db, project.id, changes)
+    _apply_language_changes(db, project.id, changes)
+
+    # updated_at is set explicitly: column onupdate hooks don't fire for ON CONFLICT updates.
+    # Pushes may reuse a commit id, so it also versions the head for cached pulls
+    now = datetime.utcnow()
+    head = {"commit_id": commit_id, "updated_at": now}
+    if any(path in README_NAMES for path in touched):
+        head["readme_path"] = _find_readme(db, project.id)
+    db.execute(
+        insert(ProjectHead)
+        .values(project_id=project.id, **head)
+        .on_conflict_do_update(index_elements=["project_id"], set_=head)
+    )
+
+
+def ensure_manifest(db: Session, project: Project) -> bool:
+    """
+    Builds the manifest of a project pushed before manifests existed, from its
+    working tree. Hashes come from the latest FileRecord of each path and are
+    only computed for files that have none. Runs once per project; returns
+    True when it built the manifest and the caller has something to commit.
+    """
+    if db.get(ProjectHead, project.id):
+        return False
+
+    project_dir = os.path.join("storage", "files", project.user.username, project.project_name)
+
+    # Latest recorded (hash, commit) per path
+    known = {path: (file_hash, commit_id) for path, file_hash, commit_id in db.execute(
+        select(FileRecord.path, FileRecord.hash, FileRecord.commit_id)
+        .join(Commit, Commit.commit_id == FileRecord.commit_id)
+        .where(Commit.project_id == project.id)
+        .order_by(FileRecord.path, Commit.created_at.desc(), FileRecord.id.desc())
+        .distinct(FileRecord.path)
+    ).all()}
+    latest_commit = db.scalar(
+        select(Commit.commit_id)
+        .where(Commit.project_id == project.id)
+        .order_by(Commit.created_at.desc())
+        .limit(1)
+    )
+
+    entries = []
+    for root, dirs, file_names in os.walk(project_dir):
+        if '.history' in dirs:
+            dirs.remove('.history')
+
+        for filename in file_names:
+            file_path = os.path.join(root, filename)
+            relative_path = os.path.relpath(file_path, project_dir).replace(os.sep, '/')
+            file_hash, commit_id = known.get(relative_path, (None, None))
+            if not file_hash or file_hash == "DELETED":
+                file_hash, commit_id = _hash_file(file_path), None
+            entries.append({
+                "project_id": project.id,
+                "path": relative_path,
+                "hash": file_hash,
+                "size": os.path.getsize(file_path),
+                "language": detect_language(relative_path),
+                "commit_id": commit_id,
+                "parent": parent_dir(relative_path),
+            })
+
+    try:
+        with db.begin_nested():
+            for start in range(0, len(entries), BATCH_SIZE):
+                db.execute(insert(ManifestEntry), entries[start:start + BATCH_SIZE])
+            paths = {entry["path"] for entry in entries}
+            readme = next((name for name in README_NAMES if name in paths), "")
+            db.add(ProjectHead(project_id=project.id, commit_id=latest_commit, readme_path=readme))
+    except IntegrityError:
+        # Another request built it concurrently
+        return False
+    return True
+
+
+def build_manifest(project_id: int) -> None:
+    """
+    Runs ensure_manifest in a session of its own and commits it. Async handlers
+    call this through run_in_threadpool so the walk and hashing of a legacy
+    project don't block the event loop.
+    """
+    db = SessionLocal()
+    try:
+        project = db.get(Project, project_id)
+        if project and ensure_manifest(db, project):
+            db.commit()
+    finally:
+        db.close()
+
+
+def _find_readme(db: Session, project_id: int) -> str:
+    present = set(db.scalars(select(ManifestEntry.path).where(
+        ManifestEntry.project_id == project_id,
+        ManifestEntry.path.in_(README_NAMES)
+    )))
+    return next((name for name in README_NAMES if name in present), "")
+
+
+def resolve_readme(db: Session, head: ProjectHead) -> str:
+    """
+    README path of a project ('' if none), recorded on its head at push time.
+    Heads recorded before that are resolved once here; the caller commits.
+    """
+    if head.readme_path is None:
+        head.readme_path = _find_readme(db, head.project_id)
+    return head.readme_path
+
+
+def _apply_directory_changes(db: Session, project_id: int, changes: list[tuple[str, int | None, int | None]]) -> None:
+    """
+    Updates directory aggregates for (path, old size, new size) file changes,
+    where a size of None means the file is absent. Directories are created when
+    they gain their first file and removed when they lose their last, except
+    the root, which always exists once built.
+    """
+    totals = defaultdict(lambda: [0, 0])
+    child_deltas = defaultdict(int)
+    for path, old_size, new_size in changes:
+        file_delta = (new_size is not None) - (old_size is not None)
+        size_delta = (new_size or 0) - (old_size or 0)
+        if not file_delta and not size_delta:
+            continue
+        for directory in _ancestors(path):
+            totals[directory][0] += file_delta
+            totals[directory][1] += size_delta
+        child_deltas[parent_dir(path)] += file_delta
+
+    paths = list(totals)
+    existing = {}
+    for start in range(0, len(paths), BATCH_SIZE):
+        existing.update((row.path, row) for row in db.scalars(
+            select(ManifestDirectory).where(
+                ManifestDirectory.project_id == project_id,
+                ManifestDirectory.path.in_(paths[start:start + BATCH_SIZE])
+            )
+        ))
+
+    # A directory appearing or disappearing changes its parent's child count
+    for path, (file_delta, _) in totals.items():
+        old_files = existing[path].file_count if path in existing else 0
+        if path and not old_files and old_files + file_delta > 0:
+            child_deltas[parent_dir(path)] += 1
+        elif path and old_files and old_files + file_delta <= 0:
+            child_deltas[parent_dir(path)] -= 1
+
+    for path, (file_delta, size_delta) in totals.items():
+        directory = existing.get(path)
+        if directory is None:
+            directory = ManifestDirectory(
+                project_id=project_id,
+                path=path,
+                parent=parent_dir(path) if path else None,
+                child_count=0,
+                file_count=0,
+                size=0
+            )
+            db.add(directory)
+        directory.file_count += file_delta
+        directory.size += size_delta
+        directory.child_count += child_deltas[path]
+        if path and directory.file_count <= 0:
+            if directory in db.new:
+                db.expunge(directory)
+            else:
+                db.delete(directory)
+
+    db.flush()
+
+
+def ensure_directories(db: Session, project: Project) -> bool:
+    """
+    Builds the directory aggregates of a project whose manifest predates them.
+    Returns True when it built them and the caller has something to commit.
+    """
+    if db.scalar(select(ManifestDirectory.id).where(
+        ManifestDirectory.project_id == project.id,
+        ManifestDirectory.path == ""
+    )):
+        return False
+
+    try:
+        with db.begin_nested():
+            db.execute(
+                update(ManifestEntry)
+                .where(ManifestEntry.project_id == project.id, ManifestEntry.parent.is_(None))
+                .values(parent=func.regexp_replace(ManifestEntry.path, "/?[^/]*$", ""))
+            )
+            db.add(ManifestDirectory(project_id=project.id, path="", parent=None, child_count=0, file_count=0, size=0))
+            db.flush()
+            _apply_directory_changes(db, project.id, [
+                (path, None, size) for path, size in db.execute(
+                    select(ManifestEntry.path, ManifestEntry.size).where(ManifestEntry.project_id == project.id)
+                )
+            ])
+    except IntegrityError:
+        # Another request built them concurrently
+        return False
+    return True
+
+
+def _apply_language_changes(db: Session, project_id: int, changes: list[tuple[str, int | None, int | None]]) -> None:
+    """Adds the byte deltas of (path, old size, new size) file changes to the project's language stats."""
+    deltas = defaultdict(int)
+    for path, old_size, new_size in changes:
+        language = detect_language(path)
+        if language:
+            deltas[language] += (new_size or 0) - (old_size or 0)
+    deltas = {language: delta for language, delta in deltas.items() if delta}
+    if not deltas:
+        return
+
+    statement = insert(LanguageStat)
+    db.execute(
+        statement.on_conflict_do_update(
+            constraint="unique_language_stat_project_language",
+            set_={"bytes": LanguageStat.bytes + statement.excluded.bytes}
+        ),
+        [{"project_id": project_id, "language": language, "bytes": delta} for language, delta in deltas.items()]
+    )
+    db.execute(delete(LanguageStat).where(LanguageStat.project_id == project_id, LanguageStat.bytes <= 0))
+
+
+def ensure_language_stats(db: Session, project: Project) -> bool:
+    """
+    Rebuilds a project's language stats when they were built with another
+    LANGUAGE_MAP_VERSION, or never: entries are reclassified and their bytes
+    summed once. Returns True when it rebuilt them and the caller has something
+    to commit.
+    """
+    head = db.get(ProjectHead, project.id)
+    if head is None or head.languages_version == LANGUAGE_MAP_VERSION:
+        return False
+    head = db.get(ProjectHead, project.id, with_for_update=True, populate_existing=True)
+    if head.languages_version == LANGUAGE_MAP_VERSION:
+        # Rebuilt while we waited for the lock
+        return False
+
+    totals = defaultdict(int)
+    reclassified = []
+    for entry_id, path, language, size in db.execute(
+        select(ManifestEntry.id, ManifestEntry.path, ManifestEntry.language, ManifestEntry.size)
+        .where(ManifestEntry.project_id == project.id)
+    ):
+        detected = detect_language(path)
+        if detected != language:
+            reclassified.append({"id": entry_id, "language": detected})
+        if detected:
+            totals[detected] += size
+
+    for start in range(0, len(reclassified), BATCH_SIZE):
+        db.execute(update(ManifestEntry), reclassified[start:start + BATCH_SIZE])
+    db.execute(delete(LanguageStat).where(LanguageStat.project_id == project.id))
+    if totals:
+        db.execute(insert(LanguageStat), [
+            {"project_id": project.id, "language": language, "bytes": size} for language, size in totals.items()
+        ])
+    head.languages_version = LANGUAGE_MAP_VERSION
+    db.flush()
+    return True
+
+
+def list_directory(db: Session, project: Project, path: str, after: tuple[str, str] | None, limit: int) -> list[ManifestDirectory | ManifestEntry] | None:
+    """
+    Up to limit immediate children of directory path, subdirectories first, each
+    group ordered by path. after is the (kind, path) of the last child already
+    returned, kind being "dir" or "file". Returns None if the directory doesn't
+    exist. Commits the manifest if it had to be built.
+    """
+    built = ensure_manifest(db, project)
+    built = ensure_directories(db, project) or built
+    if built:
+        db.commit()
+
+    if path and not db.scalar(select(ManifestDirectory.id).where(
+        ManifestDirectory.project_id == project.id,
+        ManifestDirectory.path == path
+    )):
+        return None
+
+    children = []
+    if not after or after[0] == "dir":
+        query = select(ManifestDirectory).where(
+            ManifestDirectory.project_id == project.id,
+            ManifestDirectory.parent == path
+        )
+        if after:
+            query = query.where(ManifestDirectory.path > after[1])
+        children += db.scalars(query.order_by(ManifestDirectory.path).limit(limit)).all()
+
+    if len(children) < limit:
+        query = select(ManifestEntry).where(
+            ManifestEntry.project_id == project.id,
+            ManifestEntry.parent == path
+        )
+        if after and after[0] == "file":
+            query = query.where(ManifestEntry.path > after[1])
+        children += db.scalars(query.order_by(ManifestEntry.path).limit(limit - len(children))).all()
+
+    return children
+
+
+def list_manifest(db: Session, project: Project) -> list[ManifestEntry]:
+    """Head tree of a project ordered by path. Commits the manifest if it had to be built."""
+    if ensure_manifest(db, project):
+        db.commit()
+    return db.scalars(
+        select(ManifestEntry)
+        .where(ManifestEntry.project_id == project.id)
+        .order_by(ManifestEntry.path)
+    ).all()
+
+
+def list_changes_since(db: Session, project: Project, since: Commit) -> tuple[list[ManifestEntry], list[str]]:
+    """
+    Head entries for paths added or modified in or after commit `since`, plus
+    the paths deleted since then. Paths touched come from FileRecord rows
+    joined through Commit. Files of `since` itself are included because a
+    file-by-file push keeps adding to a commit after a client may have pulled it.
+    """
+    if ensure_manifest(db, project):
+        db.commit()
+
+    touched = (
+        select(FileRecord.path)
+        .join(Commit, Commit.commit_id == FileRecord.commit_id)
+        .where(Commit.project_id == project.id, Commit.created_at >= since.created_at)
+        .distinct()
+        .subquery()
+    )
+    changed = db.scalars(
+        select(ManifestEntry)
+        .where(ManifestEntry.project_id == project.id, ManifestEntry.path.in_(select(touched.c.path)))
+        .order_by(ManifestEntry.path)
+    ).all()
+    deleted = db.scalars(
+        select(touched.c.path)
+        .where(~select(ManifestEntry.id).where(
+            ManifestEntry.project_id == project.id,
+            ManifestEntry.path == touched.c.path
+        ).exists())
+        .order_by(touched.c.path)
+    ).all()
+    return changed, deleted
+
+
+def _hash_file(path: str) -> str:
+    hasher = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(1024 * 1024):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def resolve_file_at_commit(db: Session, commit: Commit, path: str) -> FileRecord | None:
+    """
+    The FileRecord holding path as of commit: the latest one recorded in that
+    commit or an earlier commit of its project. Commits are probed newest
+    first through the (commit_id, path) index. The record may be a deletion.
+    """
+    return db.scalar(
+        select(FileRecord)
+        .join(Commit, Commit.commit_id == FileRecord.commit_id)
+        .where(
+            Commit.project_id == commit.project_id,
+            FileRecord.path == path,
+            tuple_(Commit.created_at, Commit.id) <= tuple_(commit.created_at, commit.id)
+        )
+        .order_by(Commit.created_at.desc(), Commit.id.desc(), FileRecord.id.desc())
+        .limit(1)
+    )
+
+
+def next_change_of(db: Session, commit: Commit, path: str) -> str | None:
+    """
+    Id of the first commit after commit that touched path. Its .history entry
+    holds the version path had at commit.
+    """
+    return db.scalar(
+        select(Commit.commit_id)
+        .join(FileRecord, FileRecord.commit_id == Commit.commit_id)
+        .where(
+            Commit.project_id == commit.project_id,
+            FileRecord.path == path,
+            tuple_(Commit.created_at, Commit.id) > tuple_(commit.created_at, commit.id)
+        )
+        .order_by(Commit.created_at, Commit.id)
+        .limit(1)
+    )
@@ -1,4 +1,5 @@
 from sqlalchemy import (
+    BigInteger,
     Boolean,
     Column,
     Integer,
@@ -6,6 +7,7 @@ from sqlalchemy import (
     DateTime,
     Text,
     ForeignKey,
+    Index,
     UniqueConstraint,
 )
 from sqlalchemy.orm import relationship, Mapped, mapped_column
@@ -32,6 +34,8 @@ class Project(Base):
     project_name = Column(String(100), nullable=False)
     created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
     last_updated: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
+    # Set when the project is deleted; the reaper then removes its rows and files
+    deleted_at: Mapped[datetime] = mapped_column(DateTime, nullable=True)
     
     user = relationship("User", back_populates="projects")
     commits = relationship("Commit", back_populates="project")
@@ -51,6 +55,9 @@ class Commit(Base):
     
     project = relationship("Project", back_populates="commits")
     files = relationship("FileRecord", back_populates="commit")
+    
+    # Keyset pagination of a project's history, newest first
+    __table_args__ = (Index('ix_commits_project_created_id', 'project_id', 'created_at', 'id'),)
 
 
 class FileRecord(Base):
@@ -66,6 +73,9 @@ class FileRecord(Base):
     created_at = Column(DateTime, default=datetime.utcnow)
     
     commit = relationship("Commit", back_populates="files")
+    
+    # Resolves "path as of commit" lookups
+    __table_args__ = (Index('ix_file_records_commit_path', 'commit_id', 'path'),)
 
 
 class RepoDetails(Base):
@@ -78,6 +88,11 @@ class RepoDetails(Base):
     deploy_source_path: Mapped[str] = mapped_column(String(255), nullable=True)
     downloadCount: Mapped[int] = mapped_column(Integer, default=0)
     visits: Mapped[int] = mapped_column(Integer, default=0)
+    # Deployment served by /pages; switching it is how deploys and rollbacks go live
+    deployment_id: Mapped[int] = mapped_column(Integer, ForeignKey("deployments.id"), nullable=True)
+
+    # One row per project, so star counts can be upserted
+    __table_args__ = (Index('ix_repo_details_project_id_unique', 'project_id', unique=True),)
 
 
 class Star(Base):
@@ -89,3 +104,167 @@ class Star(Base):
     created_at = Column(DateTime, default=datetime.utcnow)
     
     __table_args__ = (UniqueConstraint('user_id', 'project_id', name='unique_user_project_star'),)
+
+
+class UploadSession(Base):
+    __tablename__ = "upload_sessions"
+
+    id: Mapped[str] = mapped_column(String(36), primary_key=True)
+    user_id: Mapped[int] = mapped_column(Integer, ForeignKey("users.id"), nullable=False, index=True)
+    project_name: Mapped[str] = mapped_column(String(100), nullable=False)
+    commit_id: Mapped[str] = mapped_column(String(36), nullable=False)
+    commit_message: Mapped[str] = mapped_column(String(50), nullable=False)
+    author: Mapped[str] = mapped_column(String(100), nullable=False)
+    path: Mapped[str] = mapped_column(Text, nullable=False)
+    hash: Mapped[str] = mapped_column(String(64), nullable=False)
+    size: Mapped[int] = mapped_column(BigInteger, nullable=False)
+    last_updated: Mapped[int] = mapped_column(Integer, nullable=False)
+    # JSON list of received [start, end) byte ranges, kept merged and sorted
+    received: Mapped[str] = mapped_column(Text, nullable=False, default="[]")
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+
+# One file of a project's head tree, kept in sync at push time
+class ManifestEntry(Base):
+    __tablename__ = "manifest_entries"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, index=True)
+    project_id: Mapped[int] = mapped_column(Integer, ForeignKey("projects.id"), nullable=False)
+    path: Mapped[str] = mapped_column(Text, nullable=False)
+    hash: Mapped[str] = mapped_column(String(64), nullable=False, index=True)
+    size: Mapped[int] = mapped_column(BigInteger, nullable=False)
+    language: Mapped[str] = mapped_column(String(50), nullable=True)
+    # Commit that last added or modified this path
+    commit_id: Mapped[str] = mapped_column(String(36), nullable=True)
+    # Directory holding this path ('' for the root); NULL until backfilled
+    parent: Mapped[str] = mapped_column(Text, nullable=True)
+
+    __table_args__ = (
+        UniqueConstraint('project_id', 'path', name='unique_manifest_project_path'),
+        Index('ix_manifest_entries_project_parent_path', 'project_id', 'parent', 'path'),
+    )
+
+
+# One directory of a project's head tree ('' is the root), with aggregates kept in sync at push time
+class ManifestDirectory(Base):
+    __tablename__ = "manifest_directories"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, index=True)
+    project_id: Mapped[int] = mapped_column(Integer, ForeignKey("projects.id"), nullable=False)
+    path: Mapped[str] = mapped_column(Text, nullable=False)
+    parent: Mapped[str] = mapped_column(Text, nullable=True)
+    # Files and subdirectories directly inside
+    child_count: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    # Files and bytes anywhere below
+    file_count: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    size: Mapped[int] = mapped_column(BigInteger, nullable=False, default=0)
+
+    __table_args__ = (
+        UniqueConstraint('project_id', 'path', name='unique_manifest_directory_project_path'),
+        Index('ix_manifest_directories_project_parent_path', 'project_id', 'parent', 'path'),
+    )
+
+
+# Points a project at its head commit; a row exists once the project's manifest is built
+class ProjectHead(Base):
+    __tablename__ = "project_heads"
+
+    project_id: Mapped[int] = mapped_column(Integer, ForeignKey("projects.id"), primary_key=True)
+    commit_id: Mapped[str] = mapped_column(String(36), nullable=True)
+    updated_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    # README shown on the repo page, '' if there is none; NULL until first resolved
+    readme_path: Mapped[str] = mapped_column(Text, nullable=True)
+    # LANGUAGE_MAP_VERSION the project's language stats were built with
+    languages_version: Mapped[int] = mapped_column(Integer, nullable=True)
+
+
+# Bytes of each language in a project's head tree, kept in sync at push time
+class LanguageStat(Base):
+    __tablename__ = "language_stats"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, index=True)
+    project_id: Mapped[int] = mapped_column(Integer, ForeignKey("projects.id"), nullable=False)
+    language: Mapped[str] = mapped_column(String(50), nullable=False)
+    bytes: Mapped[int] = mapped_column(BigInteger, nullable=False, default=0)
+
+    __table_args__ = (UniqueConstraint('project_id', 'language', name='unique_language_stat_project_language'),)
+
+
+# Immutable snapshot of a project's files, as deployed to /pages
+class Deployment(Base):
+    __tablename__ = "deployments"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, index=True)
+    project_id: Mapped[int] = mapped_column(Integer, ForeignKey("projects.id"), nullable=False)
+    # SHA-256 of the source path and every (path, hash) of the snapshot
+    snapshot_id: Mapped[str] = mapped_column(String(64), nullable=False)
+    # Head commit when the snapshot was taken
+    commit_id: Mapped[str] = mapped_column(String(36), nullable=True)
+    source_path: Mapped[str] = mapped_column(String(255), nullable=False)
+    file_count: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    size: Mapped[int] = mapped_column(BigInteger, nullable=False, default=0)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (UniqueConstraint('project_id', 'snapshot_id', name='unique_deployment_project_snapshot'),)
+
+
+# One file of a deployment; content lives in the object store under hash
+class DeploymentFile(Base):
+    __tablename__ = "deployment_files"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, index=True)
+    deployment_id: Mapped[int] = mapped_column(Integer, ForeignKey("deployments.id"), nullable=False)
+    path: Mapped[str] = mapped_column(Text, nullable=False)
+    hash: Mapped[str] = mapped_column(String(64), nullable=False, index=True)
+    size: Mapped[int] = mapped_column(BigInteger, nullable=False)
+
+    __table_args__ = (UniqueConstraint('deployment_id', 'path', name='unique_deployment_file_path'),)
+
+
+# Removal of a tombstoned project, worked through in batches by the reaper
+class ProjectDeletion(Base):
+    __tablename__ = "project_deletions"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, index=True)
+    # Not a foreign key: the row outlives the project it reports on
+    project_id: Mapped[int] = mapped_column(Integer, nullable=False)
+    user_id: Mapped[int] = mapped_column(Integer, ForeignKey("users.id"), nullable=False)
+    project_name: Mapped[str] = mapped_column(String(100), nullable=False)
+    # Where the project directory was moved to await removal
+    trash_path: Mapped[str] = mapped_column(Text, nullable=True)
+    # pending until the reaper has removed everything, then done
+    status: Mapped[str] = mapped_column(String(20), nullable=False, default="pending")
+    phase: Mapped[str] = mapped_column(String(50), nullable=True)
+    files_removed: Mapped[int] = mapped_column(BigInteger, nullable=False, default=0)
+    rows_deleted: Mapped[int] = mapped_column(BigInteger, nullable=False, default=0)
+    # Last failure; the reaper retries on its next run
+    error: Mapped[str] = mapped_column(Text, nullable=True)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    finished_at: Mapped[datetime] = mapped_column(DateTime, nullable=True)
+
+
+# One run of the background consistency checker
+class ConsistencyRun(Base):
+    __tablename__ = "consistency_runs"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, index=True)
+    started_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, index=True)
+    finished_at: Mapped[datetime] = mapped_column(DateTime, nullable=True)
+    # Only projects updated after this were checked; NULL for a full check
+    checked_since: Mapped[datetime] = mapped_column(DateTime, nullable=True)
+    duration_ms: Mapped[int] = mapped_column(Integer, nullable=True)
+    projects_checked: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    files_checked: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    projects_removed: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    file_records_removed: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    # JSON list of what was found and cleaned up, capped at MAX_FINDINGS
+    findings: Mapped[str] = mapped_column(Text, nullable=False, default="[]")
+    error: Mapped[str] = mapped_column(Text, nullable=True)
+
+
+# A blob that may have become unused, waiting for the reaper to check and remove it
+class BlobSweep(Base):
+    __tablename__ = "blob_sweeps"
+
+    hash: Mapped[str] = mapped_column(String(64), primary_key=True)
+    queued_at: Mapped[datetime] = mapped_column(DateTime, nullable=False, default=datetime.utcnow, index=True)
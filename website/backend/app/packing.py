@@ -0,0 +1,104 @@
+import difflib
+import hashlib
+import itertools
+import struct
+import zlib
+
+# Packed objects start with a magic line followed by the SHA-256 and size of the
+# content they hold; delta packs also name the blob they are relative to.
+ZLIB_MAGIC = b"PMGZ1\n"
+DELTA_MAGIC = b"PMGD1\n"
+MAGIC_LENGTH = 6
+HEADER_LENGTH = MAGIC_LENGTH + 64 + 16
+DELTA_HEADER_LENGTH = HEADER_LENGTH + 64
+
+
+def encode_zlib(content: bytes, digest: str) -> bytes:
+    return ZLIB_MAGIC + digest.encode() + b"%016x" % len(content) + zlib.compress(content)
+
+
+def make_delta(base: bytes, target: bytes) -> bytes:
+    """
+    Line-based delta that rebuilds target from base.
+    Ops are b"C" + offset + length (copy from base) or b"I" + length + data (insert).
+    """
+    base_lines = base.splitlines(keepends=True)
+    target_lines = target.splitlines(keepends=True)
+    offsets = list(itertools.accumulate((len(line) for line in base_lines), initial=0))
+
+    ops = bytearray()
+    matcher = difflib.SequenceMatcher(None, base_lines, target_lines)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            ops += struct.pack(">cQQ", b"C", offsets[i1], offsets[i2] - offsets[i1])
+        elif j2 > j1:
+            data = b"".join(target_lines[j1:j2])
+            ops += struct.pack(">cQ", b"I", len(data)) + data
+    return bytes(ops)
+
+
+def apply_delta(base: bytes, ops: bytes) -> bytes:
+    out = bytearray()
+    pos = 0
+    while pos < len(ops):
+        if ops[pos:pos + 1] == b"C":
+            start, length = struct.unpack_from(">QQ", ops, pos + 1)
+            out += base[start:start + length]
+            pos += 17
+        else:
+            (length,) = struct.unpack_from(">Q", ops, pos + 1)
+            pos += 9
+            out += ops[pos:pos + length]
+            pos += length
+    return bytes(out)
+
+
+def encode_delta(content: bytes, digest: str, base: bytes, base_digest: str) -> bytes:
+    header = DELTA_MAGIC + digest.encode() + b"%016x" % len(content) + base_digest.encode()
+    return header + zlib.compress(make_delta(base, content))
+
+
+def parse_header(head: bytes) -> dict | None:
+    """
+    Reads the header of a packed object, or returns None for raw content.
+    Returns {"kind", "digest", "size", "base"}.
+    """
+    magic = head[:MAGIC_LENGTH]
+    if magic not in (ZLIB_MAGIC, DELTA_MAGIC) or len(head) < HEADER_LENGTH:
+        return None
+    try:
+        header = {
+            "kind": "zlib" if magic == ZLIB_MAGIC else "delta",
+            "digest": head[MAGIC_LENGTH:MAGIC_LENGTH + 64].decode(),
+            "size": int(head[MAGIC_LENGTH + 64:HEADER_LENGTH], 16),
+            "base": None,
+        }
+        if header["kind"] == "delta":
+            if len(head) < DELTA_HEADER_LENGTH:
+                return None
+            header["base"] = head[HEADER_LENGTH:DELTA_HEADER_LENGTH].decode()
+    except ValueError:
+        return None
+    return header
+
+
+def decode(data: bytes, base: bytes | None = None) -> bytes:
+    """
+    Reconstructs the content of a stored object. Raw content is returned as is;
+    delta packs need the content of their base blob.
+    A pack whose decoded content does not hash to its header digest is treated
+    as raw content that merely happens to start with the magic bytes.
+    """
+    header = parse_header(data[:DELTA_HEADER_LENGTH])
+    if not header:
+        return data
+    try:
+        if header["kind"] == "zlib":
+            content = zlib.decompress(data[HEADER_LENGTH:])
+        else:
+            content = apply_delta(base, zlib.decompress(data[DELTA_HEADER_LENGTH:]))
+    except (zlib.error, struct.error, TypeError):
+        return data
+    if hashlib.sha256(content).hexdigest() != header["digest"]:
+        return data
+    return content
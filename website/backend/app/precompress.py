@@ -0,0 +1,117 @@
+import gzip
+import os
+import threading
+from typing import Iterable
+
+import brotli
+
+from .archive import is_compressed
+from .storage import STORAGE_ROOT, blob_path, is_sha256, is_packed_blob, new_temp_path, read_blob
+
+PRECOMPRESSED_DIR = os.path.join(STORAGE_ROOT, "cache", "precompressed")
+
+# Smaller files gain less than the Content-Encoding header costs; larger ones
+# take too long to compress even at COMPRESSION_LEVELS' fastest settings
+PRECOMPRESS_MIN_SIZE = 1024
+PRECOMPRESS_MAX_SIZE = 32 * 1024 * 1024
+
+# Content-Encoding -> variant file extension, in order of preference
+ENCODINGS = {
+    "br": ".br",
+    "gzip": ".gz",
+}
+
+# (largest size, brotli quality, gzip level): maximum compression costs seconds
+# per MiB, so it is kept for small files and large ones trade a little ratio
+# for speed
+COMPRESSION_LEVELS = (
+    (256 * 1024, 11, 9),
+    (2 * 1024 * 1024, 9, 9),
+    (PRECOMPRESS_MAX_SIZE, 5, 6),
+)
+
+_in_progress: set[str] = set()
+_in_progress_lock = threading.Lock()
+
+
+def variant_path(digest: str, encoding: str) -> str:
+    """Variants are content-addressed like blobs, so every project and deployment shares them."""
+    return os.path.join(PRECOMPRESSED_DIR, digest[:2], digest[2:] + ENCODINGS[encoding])
+
+
+def should_precompress(path: str, size: int) -> bool:
+    return PRECOMPRESS_MIN_SIZE <= size <= PRECOMPRESS_MAX_SIZE and not is_compressed(path)
+
+
+def _compress(data: bytes, encoding: str) -> bytes:
+    _, quality, level = next(levels for levels in COMPRESSION_LEVELS if len(data) <= levels[0])
+    if encoding == "br":
+        return brotli.compress(data, quality=quality)
+    return gzip.compress(data, level, mtime=0)
+
+
+def precompress_blob(digest: str) -> None:
+    """
+    Writes the gzip and brotli variants of a blob that are missing. A variant
+    that would not be smaller than the blob is recorded as an empty file, so
+    it is neither served nor retried.
+    """
+    if not is_sha256(digest):
+        return
+    with _in_progress_lock:
+        if digest in _in_progress:
+            return
+        _in_progress.add(digest)
+    try:
+        missing = [encoding for encoding in ENCODINGS if not os.path.exists(variant_path(digest, encoding))]
+        if not missing or not os.path.exists(blob_path(digest)):
+            return
+        if is_packed_blob(digest):
+            return
+        data = read_blob(digest)
+
+        for encoding in missing:
+            compressed = _compress(data, encoding)
+            tmp_path = new_temp_path()
+            with open(tmp_path, "wb") as f:
+                if len(compressed) < len(data):
+                    f.write(compressed)
+            path = variant_path(digest, encoding)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp_path, path)
+    finally:
+        with _in_progress_lock:
+            _in_progress.discard(digest)
+
+
+def precompress_files(files: Iterable[tuple[str, str, int]]) -> None:
+    """Builds the variants of the (path, digest, size) files worth compressing."""
+    for path, digest, size in files:
+        if should_precompress(path, size):
+            try:
+                precompress_blob(digest)
+            except Exception as e:
+                print(f"Warning: Failed to precompress {path}: {e}")
+
+
+def find_variant(digest: str, accept_encoding: str | None) -> tuple[str, str] | None:
+    """Returns (encoding, path) of the preferred stored variant the client accepts, or None."""
+    if not accept_encoding:
+        return None
+    accepted = set()
+    for item in accept_encoding.split(","):
+        name, _, params = item.strip().partition(";")
+        if params.replace(" ", "") in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            continue
+        accepted.add(name.strip().lower())
+
+    for encoding in ENCODINGS:
+        if encoding not in accepted and "*" not in accepted:
+            continue
+        path = variant_path(digest, encoding)
+        try:
+            if os.path.getsize(path) > 0:
+                return encoding, path
+        except FileNotFoundError:
+            continue
+    return None
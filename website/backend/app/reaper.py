@@ -0,0 +1,159 @@
+import os
+import shutil
+from typing import Optional
+from datetime import datetime
+from sqlalchemy import delete, select, text, union, update
+from sqlalchemy.orm import Session
+from .database import SessionLocal, engine
+from .models import (
+    Project, Commit, FileRecord, Star, RepoDetails, ManifestEntry, ManifestDirectory,
+    ProjectHead, LanguageStat, Deployment, DeploymentFile, ProjectDeletion,
+)
+from .manifest import BATCH_SIZE
+from .blobs import queue_blob_sweeps
+from .deployments import deployment_dir
+from .storage import STORAGE_ROOT, project_storage_dir
+
+TRASH_DIR = os.path.join(STORAGE_ROOT, "trash")
+
+# Seconds between reaper runs; a deletion request also starts one right away
+REAPER_INTERVAL = float(os.getenv("REAPER_INTERVAL", "30"))
+
+# Tombstoned projects are renamed to this prefix plus their id, a name pushes can't create
+DELETED_NAME_PREFIX = ".deleted-"
+
+# First key of the advisory locks that let one worker at a time own a deletion
+DELETION_LOCK_CLASS = 1
+
+
+def tombstone_project(db: Session, project: Project, username: Optional[str]) -> ProjectDeletion:
+    """
+    Hides a project from reads and queues its removal. The project is renamed
+    so lookups by name miss it and the name can be reused at once, and its
+    directory (none for an orphaned project, username None) is moved into
+    TRASH_DIR. Runs in the caller's transaction; the caller must move the
+    directory back with restore_from_trash if it can't commit.
+    """
+    deletion = ProjectDeletion(project_id=project.id, user_id=project.user_id, project_name=project.project_name)
+    db.add(deletion)
+    db.flush()
+
+    project.deleted_at = datetime.utcnow()
+    project.project_name = f"{DELETED_NAME_PREFIX}{project.id}"
+
+    project_dir = project_storage_dir(username, deletion.project_name) if username else None
+    if project_dir and os.path.exists(project_dir):
+        deletion.trash_path = os.path.join(TRASH_DIR, str(deletion.id))
+        os.makedirs(TRASH_DIR, exist_ok=True)
+        os.rename(project_dir, deletion.trash_path)
+    db.flush()
+    return deletion
+
+
+def restore_from_trash(deletion: ProjectDeletion, username: str) -> None:
+    if deletion.trash_path and os.path.exists(deletion.trash_path):
+        os.rename(deletion.trash_path, project_storage_dir(username, deletion.project_name))
+
+
+def _set_progress(db: Session, deletion_id: int, **values) -> None:
+    db.execute(update(ProjectDeletion).where(ProjectDeletion.id == deletion_id).values(**values))
+    db.commit()
+
+
+def _remove_files(db: Session, deletion: ProjectDeletion) -> None:
+    """Removes the trashed directory bottom-up, reporting progress every BATCH_SIZE files."""
+    if not deletion.trash_path or not os.path.exists(deletion.trash_path):
+        return
+    removed = 0
+    for root, dirs, file_names in os.walk(deletion.trash_path, topdown=False):
+        for filename in file_names:
+            os.remove(os.path.join(root, filename))
+            removed += 1
+            if removed % BATCH_SIZE == 0:
+                _set_progress(db, deletion.id, phase="files", files_removed=ProjectDeletion.files_removed + BATCH_SIZE)
+        for dirname in dirs:
+            path = os.path.join(root, dirname)
+            if os.path.islink(path):
+                os.remove(path)
+            else:
+                os.rmdir(path)
+    shutil.rmtree(deletion.trash_path, ignore_errors=True)
+    _set_progress(db, deletion.id, phase="files", files_removed=ProjectDeletion.files_removed + removed % BATCH_SIZE)
+
+
+def _delete_in_batches(db: Session, deletion_id: int, phase: str, model, condition) -> None:
+    """Deletes model rows matching condition BATCH_SIZE at a time, committing each batch."""
+    while True:
+        batch = select(model.id).where(condition).limit(BATCH_SIZE).scalar_subquery()
+        deleted = db.execute(delete(model).where(model.id.in_(batch))).rowcount
+        _set_progress(db, deletion_id, phase=phase, rows_deleted=ProjectDeletion.rows_deleted + deleted)
+        if deleted < BATCH_SIZE:
+            return
+
+
+def _reap(db: Session, deletion: ProjectDeletion) -> None:
+    project_id = deletion.project_id
+    _remove_files(db, deletion)
+
+    commit_ids = select(Commit.commit_id).where(Commit.project_id == project_id)
+    deployment_ids = select(Deployment.id).where(Deployment.project_id == project_id)
+    for deployment_id in db.scalars(deployment_ids).all():
+        shutil.rmtree(deployment_dir(deployment_id), ignore_errors=True)
+    # Every link of the project is gone now, so its blobs can be queued; the
+    # sweep keeps those another project still uses
+    queue_blob_sweeps(db, db.scalars(union(
+        select(FileRecord.hash).where(FileRecord.commit_id.in_(commit_ids), FileRecord.hash != "DELETED"),
+        select(ManifestEntry.hash).where(ManifestEntry.project_id == project_id),
+        select(DeploymentFile.hash).where(DeploymentFile.deployment_id.in_(deployment_ids)),
+    )))
+    _set_progress(db, deletion.id, phase="blobs")
+    _delete_in_batches(db, deletion.id, "stars", Star, Star.project_id == project_id)
+    _delete_in_batches(db, deletion.id, "repo_details", RepoDetails, RepoDetails.project_id == project_id)
+    _delete_in_batches(db, deletion.id, "deployment_files", DeploymentFile, DeploymentFile.deployment_id.in_(deployment_ids))
+    _delete_in_batches(db, deletion.id, "deployments", Deployment, Deployment.project_id == project_id)
+    _delete_in_batches(db, deletion.id, "manifest_entries", ManifestEntry, ManifestEntry.project_id == project_id)
+    _delete_in_batches(db, deletion.id, "manifest_directories", ManifestDirectory, ManifestDirectory.project_id == project_id)
+    _delete_in_batches(db, deletion.id, "language_stats", LanguageStat, LanguageStat.project_id == project_id)
+    db.execute(delete(ProjectHead).where(ProjectHead.project_id == project_id))
+    _delete_in_batches(db, deletion.id, "file_records", FileRecord, FileRecord.commit_id.in_(commit_ids))
+    _delete_in_batches(db, deletion.id, "commits", Commit, Commit.project_id == project_id)
+    db.execute(delete(Project).where(Project.id == project_id))
+    _set_progress(db, deletion.id, status="done", phase=None, error=None, finished_at=datetime.utcnow())
+
+
+def reap_deletions() -> int:
+    """
+    Works through pending deletions. Each one is owned through a session-level
+    advisory lock, so any number of workers can run this at once without doing
+    the same deletion twice. Returns how many deletions it finished.
+    """
+    finished = 0
+    with engine.connect() as lock_conn:
+        db = SessionLocal()
+        try:
+            pending = db.scalars(
+                select(ProjectDeletion.id).where(ProjectDeletion.status == "pending").order_by(ProjectDeletion.id)
+            ).all()
+            db.commit()
+            for deletion_id in pending:
+                locked = lock_conn.scalar(text("SELECT pg_try_advisory_lock(:class, :id)"), {"class": DELETION_LOCK_CLASS, "id": deletion_id})
+                # The lock belongs to the session, so don't sit idle in a transaction while holding it
+                lock_conn.commit()
+                if not locked:
+                    continue
+                try:
+                    deletion = db.get(ProjectDeletion, deletion_id, populate_existing=True)
+                    if deletion.status != "pending":
+                        continue
+                    _reap(db, deletion)
+                    finished += 1
+                except Exception as e:
+                    db.rollback()
+                    print(f"Error reaping deletion {deletion_id}: {e}")
+                    _set_progress(db, deletion_id, error=str(e))
+                finally:
+                    lock_conn.execute(text("SELECT pg_advisory_unlock(:class, :id)"), {"class": DELETION_LOCK_CLASS, "id": deletion_id})
+                    lock_conn.commit()
+        finally:
+            db.close()
+    return finished
@@ -1,90 +1,253 @@
-from fastapi import APIRouter, Depends, HTTPException
-from fastapi.responses import FileResponse
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, Depends, HTTPException, Header
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse, Response
+from sqlalchemy import and_, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import Optional
+from email.utils import format_datetime, parsedate_to_datetime
+from datetime import datetime, timezone
+import asyncio
+import mimetypes
 import os
-from ..database import get_db
-from ..models import User, Project, RepoDetails
+from ..database import SessionLocal, get_async_db
+from ..models import User, Project, RepoDetails, Deployment, DeploymentFile
+from ..cache import page_sites, page_assets
+from ..deployments import create_deployment, activate_deployment, deployment_dir, link_deployment
+from ..precompress import find_variant, precompress_files, should_precompress, variant_path
+from ..storage import blob_path, is_packed_blob, read_blob
 
 router = APIRouter(prefix="/pages")
 
+# How long browsers may reuse a page asset before revalidating it with its ETag
+PAGES_MAX_AGE = int(os.getenv("PAGES_MAX_AGE", "60"))
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+# Paths starting with @<snapshot_id>/ address a retained deployment
+SNAPSHOT_PREFIX = "@"
+
+async def _get_deployed_site(db: AsyncSession, username: str, project_name: str, snapshot_id: Optional[str] = None) -> dict:
+    """
+    Resolves the live deployment of a site, or the retained deployment
+    snapshot_id, as {"deployment_id", "source_path", "created_at"} from
+    page_sites or a single query. Missing and undeployed projects are cached too.
+    """
+    key = (username, project_name, snapshot_id)
+    site = page_sites.get(key)
+    if site is None:
+        if snapshot_id:
+            deployment_join = and_(Deployment.project_id == Project.id, Deployment.snapshot_id == snapshot_id)
+        else:
+            deployment_join = Deployment.id == RepoDetails.deployment_id
+        query = (
+            select(
+                Project.id,
+                RepoDetails.isDeployed,
+                RepoDetails.deploy_source_path,
+                Deployment.id.label("deployment_id"),
+                Deployment.source_path,
+                Deployment.created_at
+            )
+            .select_from(User)
+            .outerjoin(Project, and_(
+                Project.user_id == User.id,
+                Project.project_name == project_name,
+                Project.deleted_at.is_(None)
+            ))
+            .outerjoin(RepoDetails, RepoDetails.project_id == Project.id)
+            .outerjoin(Deployment, deployment_join)
+            .where(User.username == username)
+        )
+        row = (await db.execute(query)).first()
+
+        if row and row.isDeployed and row.deployment_id is None and not snapshot_id:
+            # Deployed before deployments were snapshotted
+            # Snapshotting copies and hashes legacy files, so it runs in a worker thread
+            await run_in_threadpool(_snapshot_live_site, row.id, row.deploy_source_path or "index.html")
+            row = (await db.execute(query)).first()
+
+        # Verify project exists and is deployed
+        if not row:
+            site = {"error": "User not found"}
+        elif row.id is None:
+            site = {"error": "Project not found"}
+        elif not row.isDeployed:
+            site = {"error": "Project is not deployed"}
+        elif row.deployment_id is None:
+            site = {"error": "Deployment not found"}
+        else:
+            site = {
+                "deployment_id": row.deployment_id,
+                "source_path": row.source_path,
+                "created_at": row.created_at
+            }
+        page_sites.set(key, site)
+
+    if "error" in site:
+        raise HTTPException(status_code=404, detail=site["error"])
+    return site
+
+def _snapshot_live_site(project_id: int, source_path: str) -> None:
+    db = SessionLocal()
+    try:
+        deployment = create_deployment(db, db.get(Project, project_id), source_path)
+        if deployment:
+            activate_deployment(db, project_id, deployment)
+            deployment_id = deployment.id
+            db.commit()
+            link_deployment(deployment_id, db.execute(
+                select(DeploymentFile.path, DeploymentFile.hash, DeploymentFile.size)
+                .where(DeploymentFile.deployment_id == deployment_id)
+            ).all())
+    finally:
+        db.close()
+
+async def _get_site_files(db: AsyncSession, site: dict) -> dict[str, tuple[str, int]]:
+    """Files of a deployment as {path: (hash, size)}. Deployments never change, so they are loaded once."""
+    key = site["deployment_id"]
+    files = page_assets.get(key)
+    if files is None:
+        rows = await db.execute(
+            select(DeploymentFile.path, DeploymentFile.hash, DeploymentFile.size)
+            .where(DeploymentFile.deployment_id == key)
+        )
+        files = {path: (digest, size) for path, digest, size in rows}
+        if not os.path.isdir(deployment_dir(key)):
+            # Deployed before deployments pinned their blobs
+            await run_in_threadpool(link_deployment, key, [(path, digest, size) for path, (digest, size) in files.items()])
+        page_assets.set(key, files)
+    return files
+
+def _find_page_file(files: dict[str, tuple], file_path: str) -> Optional[str]:
+    # Only paths of the deployment resolve, so there is nothing to traverse out of
+    file_path = file_path.strip("/")
+    if file_path in files:
+        return file_path
+    # Serve index.html for a directory
+    index_path = f"{file_path}/index.html" if file_path else "index.html"
+    if index_path in files:
+        return index_path
+    return None
+
+def _locate_file(digest: str, size: int, path: str, accept_encoding: Optional[str]) -> tuple[Optional[str], Optional[str], bool]:
+    """
+    Picks what to send for a file: (disk path, Content-Encoding, whether its
+    compressed variants still have to be built). The disk path is None when the
+    blob has been packed since it was deployed and must be decoded.
+    """
+    compressible = should_precompress(path, size)
+    if compressible:
+        variant = find_variant(digest, accept_encoding)
+        if variant:
+            encoding, file_path = variant
+            return file_path, encoding, False
+    if not os.path.exists(blob_path(digest)):
+        raise HTTPException(status_code=404, detail="File not found")
+    if is_packed_blob(digest):
+        # Packed blobs aren't precompressed
+        return None, None, False
+    return blob_path(digest), None, compressible and not os.path.exists(variant_path(digest, "gzip"))
+
+def _not_modified(etag: str, last_modified: Optional[datetime], if_none_match: Optional[str], if_modified_since: Optional[str]) -> bool:
+    if if_none_match:
+        tags = [tag.strip() for tag in if_none_match.split(",")]
+        return "*" in tags or etag in tags or f"W/{etag}" in tags
+    if if_modified_since and last_modified:
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        if since.tzinfo is None:
+            since = since.replace(tzinfo=timezone.utc)
+        return last_modified.replace(microsecond=0) <= since
+    return False
+
+async def _serve_site_file(
+    db: AsyncSession,
+    site: dict,
+    files: dict[str, tuple],
+    path: str,
+    immutable: bool,
+    accept_encoding: Optional[str],
+    if_none_match: Optional[str],
+    if_modified_since: Optional[str]
+) -> Response:
+    # Nothing else is read from the database for this request
+    await db.close()
+
+    digest, size = files[path]
+    media_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+    headers = {"Cache-Control": IMMUTABLE_CACHE_CONTROL if immutable else f"public, max-age={PAGES_MAX_AGE}"}
+    if should_precompress(path, size):
+        headers["Vary"] = "Accept-Encoding"
+
+    # Filesystem checks run in a worker thread so a slow disk doesn't stall the event loop
+    file_path, encoding, needs_precompress = await run_in_threadpool(_locate_file, digest, size, path, accept_encoding)
+
+    if needs_precompress:
+        # Variants missing since the deploy (e.g. removed from the cache) are rebuilt in the background
+        asyncio.get_running_loop().run_in_executor(None, precompress_files, [(path, digest, size)])
+
+    # Each representation has its own strong ETag
+    etag = f'"{digest}.{encoding}"' if encoding else f'"{digest}"'
+    headers["ETag"] = etag
+    last_modified = site["created_at"].replace(tzinfo=timezone.utc)
+    headers["Last-Modified"] = format_datetime(last_modified, usegmt=True)
+    if encoding:
+        headers["Content-Encoding"] = encoding
+
+    if _not_modified(etag, last_modified, if_none_match, if_modified_since):
+        return Response(status_code=304, headers=headers)
+    if file_path is None:
+        return Response(await run_in_threadpool(read_blob, digest), media_type=media_type, headers=headers)
+    return FileResponse(file_path, media_type=media_type, headers=headers)
+
+def _source_file(site: dict, files: dict[str, tuple]) -> str:
+    source_path = site["source_path"]
+    if source_path not in files:
+        raise HTTPException(status_code=404, detail=f"Source file '{source_path}' not found")
+    return source_path
+
 @router.get("/{username}/{project_name}/{file_path:path}")
 async def serve_page(
     username: str,
     project_name: str,
     file_path: str,
-    db: Session = Depends(get_db)
+    accept_encoding: Optional[str] = Header(None),
+    if_none_match: Optional[str] = Header(None),
+    if_modified_since: Optional[str] = Header(None),
+    db: AsyncSession = Depends(get_async_db)
 ):
-    # Verify project exists and is deployed
-    project_owner = db.query(User).filter(User.username == username).first()
-    if not project_owner:
-        raise HTTPException(status_code=404, detail="User not found")
-    
-    project = db.query(Project).filter(
-        Project.user_id == project_owner.id,
-        Project.project_name == project_name
-    ).first()
-    
-    if not project:
-        raise HTTPException(status_code=404, detail="Project not found")
-        
-    repo_details = db.query(RepoDetails).filter(RepoDetails.project_id == project.id).first()
-    
-    if not repo_details or not repo_details.isDeployed:
-        raise HTTPException(status_code=404, detail="Project is not deployed")
-    
-    # Construct file path
-    # If file_path is empty or ends with /, append the source path (e.g. index.html)
-    # However, the route definition {file_path:path} might capture empty string as well if we use a different setup, 
-    # but usually it requires at least a slash.
-    # Let's assume the frontend redirects to .../index.html or the user links to it.
-    # Actually, for a "site", we often want root to serve index.html.
-    
-    base_path = os.path.join("storage", "files", username, project_name)
-    full_path = os.path.join(base_path, file_path)
-    
-    # Security check to prevent directory traversal
-    if not os.path.abspath(full_path).startswith(os.path.abspath(base_path)):
-        raise HTTPException(status_code=403, detail="Access denied")
-        
-    if os.path.isdir(full_path):
-        # Try to serve index.html if it's a directory
-        full_path = os.path.join(full_path, "index.html")
-        
-    if not os.path.exists(full_path):
+    """
+    Serves a file of the live deployment. Paths under @<snapshot_id>/ serve
+    that deployment instead; its content can never change, so it is cached
+    as immutable, and relative URLs in its pages stay inside the snapshot.
+    """
+    snapshot_id = None
+    if file_path.startswith(SNAPSHOT_PREFIX):
+        snapshot_id, _, file_path = file_path[len(SNAPSHOT_PREFIX):].partition("/")
+    site = await _get_deployed_site(db, username, project_name, snapshot_id)
+    files = await _get_site_files(db, site)
+
+    if snapshot_id and not file_path:
+        path = _source_file(site, files)
+    else:
+        path = _find_page_file(files, file_path)
+    if path is None:
         raise HTTPException(status_code=404, detail="File not found")
-        
-    return FileResponse(full_path)
+
+    return await _serve_site_file(db, site, files, path, bool(snapshot_id), accept_encoding, if_none_match, if_modified_since)
 
 @router.get("/{username}/{project_name}")
 async def serve_root(
     username: str,
     project_name: str,
-    db: Session = Depends(get_db)
+    accept_encoding: Optional[str] = Header(None),
+    if_none_match: Optional[str] = Header(None),
+    if_modified_since: Optional[str] = Header(None),
+    db: AsyncSession = Depends(get_async_db)
 ):
-    # Redirect to the source path configured for the project
-    project_owner = db.query(User).filter(User.username == username).first()
-    if not project_owner:
-        raise HTTPException(status_code=404, detail="User not found")
-    
-    project = db.query(Project).filter(
-        Project.user_id == project_owner.id,
-        Project.project_name == project_name
-    ).first()
-    
-    if not project:
-        raise HTTPException(status_code=404, detail="Project not found")
-        
-    repo_details = db.query(RepoDetails).filter(RepoDetails.project_id == project.id).first()
-    
-    if not repo_details or not repo_details.isDeployed:
-        raise HTTPException(status_code=404, detail="Project is not deployed")
-        
-    source_path = repo_details.deploy_source_path or "index.html"
-    
-    base_path = os.path.join("storage", "files", username, project_name)
-    full_path = os.path.join(base_path, source_path)
-    
-    if not os.path.exists(full_path):
-        raise HTTPException(status_code=404, detail=f"Source file '{source_path}' not found")
-        
-    return FileResponse(full_path)
+    # Serve the source path configured for the deployment
+    site = await _get_deployed_site(db, username, project_name)
+    files = await _get_site_files(db, site)
+
+    return await _serve_site_file(db, site, files, _source_file(site, files), False, accept_encoding, if_none_match, if_modified_since)
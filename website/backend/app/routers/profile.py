@@ -1,38 +1,54 @@
 from fastapi import APIRouter, Depends, HTTPException
 from sqlalchemy.orm import Session
+from typing import Optional
 import hashlib
 import os
 import json
 import time
 from ..database import get_db
-from ..models import User, Project
-from ..consistency import run_consistency_check_if_needed
+from ..models import User, Project, RepoDetails
+from ..dependencies import get_optional_user
+from ..stars import starred_projects
 
 router = APIRouter(prefix="/api")
 
 CACHE_FILE = "temp/latest_repos_cache.json"
 CACHE_EXPIRATION = 3600  # 1 hour in seconds
 
+def _mark_starred(db: Session, viewer: Optional[User], cards: list[dict], username: Optional[str] = None) -> None:
+    """Sets is_starred on each project card with a single lookup; always False for anonymous viewers."""
+    refs = [(card.get("username", username), card["project_name"]) for card in cards]
+    starred = starred_projects(db, viewer.id, refs) if viewer else set()
+    for card, ref in zip(cards, refs):
+        card["is_starred"] = ref in starred
+
 @router.get("/search/{query}")
 def search_projects(
     query: str,
+    viewer: Optional[User] = Depends(get_optional_user),
     db: Session = Depends(get_db)
 ):
     try:
-        projects = db.query(Project).filter(Project.project_name.ilike(f"%{query}%")).all()
+        projects = db.query(Project, User.username, RepoDetails.stars).join(
+            User, Project.user_id == User.id
+        ).outerjoin(
+            RepoDetails, RepoDetails.project_id == Project.id
+        ).filter(
+            Project.project_name.ilike(f"%{query}%"),
+            Project.deleted_at.is_(None)
+        ).all()
         
         result = []
-        for project in projects:
-            owner = db.query(User).filter(User.id == project.user_id).first()
-            if not owner:
-                continue
+        for project, username, stars in projects:
             result.append({
-                "username": owner.username,
+                "username": username,
                 "project_name": project.project_name,
                 "created_at": project.created_at.isoformat(),
                 "last_updated": project.last_updated.isoformat(),
-                "view_url": f"/api/repo/{owner.username}/{project.project_name}"
+                "stars": stars or 0,
+                "view_url": f"/api/repo/{username}/{project.project_name}"
             })
+        _mark_starred(db, viewer, result)
         
         return {
             "results": result
@@ -44,11 +60,9 @@ def search_projects(
 
 @router.get("/latest-repos")
 def get_latest_repos(
+    viewer: Optional[User] = Depends(get_optional_user),
     db: Session = Depends(get_db)
 ):
-    # Run consistency check with cooldown
-    run_consistency_check_if_needed(db)
-
     try:
         # Check if cache exists and is valid
         if os.path.exists(CACHE_FILE):
@@ -57,6 +71,7 @@ def get_latest_repos(
                 try:
                     with open(CACHE_FILE, "r") as f:
                         cached_data = json.load(f)
+                    _mark_starred(db, viewer, cached_data["projects"])
                     return cached_data
                 except Exception as cache_err:
                     print(f"Warning: Failed to read cache: {cache_err}")
@@ -64,6 +79,8 @@ def get_latest_repos(
         # If cache doesn't exist or is expired, query DB
         results = db.query(Project, User.username).join(
             User, Project.user_id == User.id
+        ).filter(
+            Project.deleted_at.is_(None)
         ).order_by(
             Project.last_updated.desc()
         ).limit(5).all()
@@ -87,6 +104,8 @@ def get_latest_repos(
         except Exception as cache_err:
             print(f"Warning: Failed to write cache: {cache_err}")
         
+        # The cache is shared by all viewers, so stars are marked after it is written
+        _mark_starred(db, viewer, project_list)
         return response_data
     except Exception as e:
         print(f"CRITICAL: Error getting latest repos: {e}")
@@ -95,25 +114,27 @@ def get_latest_repos(
 @router.get("/profile/{username}")
 def get_profile(
     username: str,
+    viewer: Optional[User] = Depends(get_optional_user),
     db: Session = Depends(get_db)
 ):
-    # Run consistency check with cooldown
-    run_consistency_check_if_needed(db)
-
     try:
         user = db.query(User).filter(User.username == username).first()
         if not user:
             raise HTTPException(status_code=404, detail="User not found")
         
-        projects = db.query(Project).filter(Project.user_id == user.id).all()
+        projects = db.query(Project, RepoDetails.stars).outerjoin(
+            RepoDetails, RepoDetails.project_id == Project.id
+        ).filter(Project.user_id == user.id, Project.deleted_at.is_(None)).all()
         
         project_list = []
-        for project in projects:
+        for project, stars in projects:
             project_list.append({
                 "project_name": project.project_name,
                 "created_at": project.created_at.isoformat(),
-                "last_updated": project.last_updated.isoformat()
+                "last_updated": project.last_updated.isoformat(),
+                "stars": stars or 0
             })
+        _mark_starred(db, viewer, project_list, username=user.username)
         
         # Generate Gravatar URL
         email_hash = hashlib.md5(user.email.lower().strip().encode('utf-8')).hexdigest()
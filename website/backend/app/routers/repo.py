@@ -1,21 +1,164 @@
-from fastapi import APIRouter, Depends, HTTPException, Form, File, UploadFile, Header, BackgroundTasks
-from fastapi.responses import FileResponse
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, Form, File, UploadFile, Header, Query, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse, Response, StreamingResponse
+from starlette.requests import ClientDisconnect
+from sqlalchemy import and_, func, insert, literal, select, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, aliased
 from typing import Optional
 import os
+import json
 import shutil
-import hashlib
-import zipfile
+import tarfile
+import uuid
 import base64
-from datetime import datetime
+import asyncio
+import mimetypes
+from datetime import datetime, timedelta
 
-from ..database import get_db
-from ..models import User, Project, Commit, FileRecord, RepoDetails, Star
-from ..dependencies import get_current_user
-from ..consistency import run_consistency_check_if_needed
+from ..database import get_db, get_async_db
+from ..models import User, Project, Commit, FileRecord, RepoDetails, Star, UploadSession, ManifestEntry, ManifestDirectory, ProjectHead, LanguageStat, Deployment, DeploymentFile, ProjectDeletion, ConsistencyRun
+from ..dependencies import get_current_user, get_current_user_async
+from ..precompress import precompress_files
+from ..forks import copy_project_records
+from ..blobs import queue_blob_sweeps
+from ..deployments import create_deployment, activate_deployment, link_deployment, prune_deployments
+from ..reaper import DELETED_NAME_PREFIX, tombstone_project, restore_from_trash, reap_deletions
+from ..stars import STARRED_LOOKUP_MAX, toggle_star, starred_projects
+from ..archive import ARCHIVE_FORMATS, stream_archive
+from ..cache import head_cache, head_changes, head_changed, deployment_changed
+from ..archive_cache import archive_key, get_cached_archive, cache_archive_stream, invalidate_project_archives
+from ..manifest import record_file_changes, ensure_manifest, build_manifest, ensure_language_stats, list_manifest, list_changes_since, list_directory, resolve_readme, resolve_file_at_commit, next_change_of
+from ..storage import (
+    project_storage_dir,
+    blob_path,
+    blob_size,
+    is_packed_blob,
+    read_blob,
+    has_blob,
+    reuse_blob,
+    is_sha256,
+    store_upload,
+    store_blob_from_file,
+    hash_path,
+    store_hashed_path,
+    upload_part_path,
+    create_upload_part,
+    open_upload_part,
+    delete_upload_part,
+    update_working_file,
+    remove_working_file,
+    link_project_tree,
+)
 
 router = APIRouter(prefix="/api")
 
+def _get_or_create_project(db: Session, user: User, project_name: str) -> Project:
+    project = db.query(Project).filter(
+        Project.user_id == user.id,
+        Project.project_name == project_name,
+        Project.deleted_at.is_(None)
+    ).first()
+    
+    if not project:
+        # Reserved for projects waiting to be reaped
+        if project_name.startswith(DELETED_NAME_PREFIX):
+            raise HTTPException(status_code=400, detail="Invalid project name")
+        project = Project(user_id=user.id, project_name=project_name)
+        db.add(project)
+        db.flush()
+    
+    return project
+
+def _get_or_create_commit(db: Session, project: Project, commit_id: str, commit_message: str, author: str) -> Commit:
+    commit = db.query(Commit).filter(Commit.commit_id == commit_id).first()
+    
+    if not commit:
+        commit = Commit(
+            commit_id=commit_id,
+            project_id=project.id,
+            commit_message=commit_message,
+            author=author
+        )
+        db.add(commit)
+        db.flush()
+    
+    return commit
+
+def _invalidate_latest_repos_cache() -> None:
+    cache_file = "temp/latest_repos_cache.json"
+    if os.path.exists(cache_file):
+        try:
+            os.remove(cache_file)
+        except Exception as e:
+            print(f"Warning: Failed to invalidate cache: {e}")
+
+def _invalidate_caches(project: Project, username: str) -> None:
+    """Called after a push lands: drops caches that reflect the old head."""
+    _invalidate_latest_repos_cache()
+    head_changed(username, project.project_name)
+    try:
+        invalidate_project_archives(project.id)
+    except Exception as e:
+        print(f"Warning: Failed to invalidate pull archives: {e}")
+
+def _check_file_path(path: str) -> None:
+    """
+    Rejects paths that could leave the project's working tree or reach into its
+    .history. Working files are hardlinks into the object store, so writing
+    through a path like ../../../objects/... would change content every
+    project with that blob serves.
+    """
+    parts = path.split("/")
+    if any(part in ("", ".", "..") for part in parts) or parts[0] == ".history" or "\0" in path:
+        raise HTTPException(status_code=400, detail=f"Invalid file path '{path}'")
+
+def _parse_manifest(manifest: str) -> dict[str, dict]:
+    """Parses a JSON list of {path, hash, last_updated} entries, keyed by path."""
+    try:
+        parsed = json.loads(manifest)
+        if not isinstance(parsed, list):
+            raise TypeError("manifest must be a list")
+        entries = {entry["path"]: entry for entry in parsed}
+        for entry in entries.values():
+            entry["last_updated"] = int(entry["last_updated"])
+            if not isinstance(entry["hash"], str):
+                raise TypeError("hash must be a string")
+    except (ValueError, TypeError, KeyError):
+        raise HTTPException(status_code=400, detail="Manifest must be a JSON list of {path, hash, last_updated}")
+    for path in entries:
+        _check_file_path(path)
+    return entries
+
+def _apply_file_change(project_storage: str, commit_id: str, path: str, file_hash: str, file_size: int, last_updated: int) -> dict:
+    """Updates the working tree for one stored (or deleted) file and returns its FileRecord row."""
+    if file_hash == "DELETED":
+        remove_working_file(project_storage, commit_id, path)
+        storage_path = os.path.join(project_storage, path)
+    else:
+        update_working_file(project_storage, commit_id, path, file_hash)
+        storage_path = blob_path(file_hash)
+    
+    return {
+        "commit_id": commit_id,
+        "path": path,
+        "hash": file_hash,
+        "last_updated": last_updated,
+        "storage_path": storage_path,
+        "file_size": file_size
+    }
+
+async def _build_legacy_manifest(db: AsyncSession, project: Project) -> None:
+    """Builds the manifest of a project pushed before manifests existed in a worker thread."""
+    if not await db.get(ProjectHead, project.id):
+        await run_in_threadpool(build_manifest, project.id)
+
+def _record_file_rows(db: Session, project: Project, commit_id: str, rows: list[dict]) -> None:
+    """Bulk-inserts FileRecord rows and applies them to the project's manifest."""
+    if rows:
+        db.execute(insert(FileRecord), rows)
+        record_file_changes(db, project, commit_id, rows)
+
 @router.post("/push/file")
 async def push_file(
     commit_id: str = Form(...),
@@ -26,107 +169,40 @@ async def push_file(
     commit_message: str = Form(...),
     author: str = Form(...),
     file: Optional[UploadFile] = File(None),
-    user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    user: User = Depends(get_current_user_async),
+    db: AsyncSession = Depends(get_async_db)
 ) -> dict[str, str]:
     try:
-        # Get or create project
-        project = db.query(Project).filter(
-            Project.user_id == user.id,
-            Project.project_name == project_name
-        ).first()
-        
-        if not project:
-            project = Project(user_id=user.id, project_name=project_name)
-            db.add(project)
-            db.flush()
-        
-        # Get or create commit
-        commit = db.query(Commit).filter(Commit.commit_id == commit_id).first()
-        
-        if not commit:
-            commit = Commit(
-                commit_id=commit_id,
-                project_id=project.id,
-                commit_message=commit_message,
-                author=author
-            )
-            db.add(commit)
-            db.flush()
+        _check_file_path(path)
+        project = await db.run_sync(_get_or_create_project, user, project_name)
+        await db.run_sync(_get_or_create_commit, project, commit_id, commit_message, author)
         
         # Define storage paths
-        username = user.username  # Assuming User model has username field
-        project_storage = os.path.join("storage", "files", username, project_name)
-        file_path_full = os.path.join(project_storage, path)
+        project_storage = project_storage_dir(user.username, project_name)
         
         if hash == "DELETED":
-            # Handle deletion
-            if os.path.exists(file_path_full):
-                history_dir = os.path.join(project_storage, ".history", commit_id)
-                os.makedirs(history_dir, exist_ok=True)
-                
-                backup_path = os.path.join(history_dir, path)
-                os.makedirs(os.path.dirname(backup_path), exist_ok=True)
-                
-                # Move old file to history (effectively deleting it from current view)
-                shutil.move(file_path_full, backup_path)
-            
+            # Old file moves to history (effectively deleting it from current view)
             file_size = 0
-            
         else:
             if not file:
                 raise HTTPException(status_code=400, detail="File content required for non-deleted files")
 
-            # Read and verify file
-            file_content = await file.read()
-            calculated_hash = hashlib.sha256(file_content).hexdigest()
-            
+            # Stream the file into the content-addressed object store
             # Use the calculated hash of the uploaded content
             # This ensures the database reflects the actual content stored,
             # even if the file changed between commit and push.
-            hash = calculated_hash
-            
-            os.makedirs(os.path.dirname(file_path_full), exist_ok=True)
-            
-            # Backup existing file if it exists
-            if os.path.exists(file_path_full):
-                history_dir = os.path.join(project_storage, ".history", commit_id)
-                os.makedirs(history_dir, exist_ok=True)
-                
-                backup_path = os.path.join(history_dir, path)
-                os.makedirs(os.path.dirname(backup_path), exist_ok=True)
-                
-                # Copy old file to history
-                shutil.copy2(file_path_full, backup_path)
-            
-            # Save new file
-            with open(file_path_full, "wb") as f:
-                f.write(file_content)
-            
-            file_size = len(file_content)
+            hash, file_size = await store_upload(file)
         
         # Create file record
-        file_record = FileRecord(
-            commit_id=commit_id,
-            path=path,
-            hash=hash,
-            last_updated=last_updated,
-            storage_path=file_path_full,
-            file_size=file_size
-        )
-        db.add(file_record)
+        await _build_legacy_manifest(db, project)
+        file_record = await run_in_threadpool(_apply_file_change, project_storage, commit_id, path, hash, file_size, last_updated)
+        await db.run_sync(_record_file_rows, project, commit_id, [file_record])
         
         # Update project timestamp
         project.last_updated = datetime.utcnow()
-        db.commit()
+        await db.commit()
 
-        # Invalidate latest repos cache
-        cache_file = "temp/latest_repos_cache.json"
-        if os.path.exists(cache_file):
-            try:
-                os.remove(cache_file)
-            except Exception as e:
-                print(f"Warning: Failed to invalidate cache: {e}")
+        await run_in_threadpool(_invalidate_caches, project, user.username)
         
         return {
             "success": "true",
@@ -138,19 +214,426 @@ async def push_file(
     except HTTPException:
         raise
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         print(f"Error uploading file: {e}")
         raise HTTPException(status_code=500, detail=f"Failed to save file: {str(e)}")
+
+def _queue_rejected_blobs(db: Session, hashes: list[str]) -> None:
+    """Queues the blobs a failed push stored so the sweep can drop those nothing else uses."""
+    if not hashes:
+        return
+    try:
+        queue_blob_sweeps(db, hashes)
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        print(f"Error queueing blobs of a failed push: {e}")
+
+
+@router.post("/push/commit")
+def push_commit(
+    commit_id: str = Form(...),
+    project_name: str = Form(...),
+    commit_message: str = Form(...),
+    author: str = Form(...),
+    manifest: str = Form(...),
+    archive: Optional[UploadFile] = File(None),
+    user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """
+    Pushes a whole commit in one request and one transaction.
+    `manifest` is a JSON list of {"path", "hash", "last_updated"} entries and
+    `archive` is a tar (optionally compressed) holding one member per
+    non-deleted entry, named by its path.
+    """
+    stored = {}
+    try:
+        entries = _parse_manifest(manifest)
+        expected = {path for path, entry in entries.items() if entry["hash"] != "DELETED"}
+        if expected and not archive:
+            raise HTTPException(status_code=400, detail="Archive required for non-deleted files")
+        
+        project = _get_or_create_project(db, user, project_name)
+        _get_or_create_commit(db, project, commit_id, commit_message, author)
+        project_storage = project_storage_dir(user.username, project_name)
+        
+        # Store content first; the tar is read sequentially as a stream
+        if archive:
+            try:
+                with tarfile.open(fileobj=archive.file, mode="r|*") as tar:
+                    for member in tar:
+                        if not member.isfile():
+                            continue
+                        path = member.name.removeprefix("./")
+                        _check_file_path(path)
+                        if path not in expected:
+                            raise HTTPException(status_code=400, detail=f"Archive member '{path}' is not in the manifest")
+                        stored[path] = store_blob_from_file(tar.extractfile(member))
+            except tarfile.TarError as e:
+                raise HTTPException(status_code=400, detail=f"Invalid archive: {str(e)}")
+        
+        missing = expected - stored.keys()
+        if missing:
+            raise HTTPException(status_code=400, detail=f"Archive is missing files: {', '.join(sorted(missing))}")
+        
+        rows = []
+        for path, entry in entries.items():
+            file_hash, file_size = stored.get(path, ("DELETED", 0))
+            rows.append(_apply_file_change(project_storage, commit_id, path, file_hash, file_size, entry["last_updated"]))
+        
+        _record_file_rows(db, project, commit_id, rows)
+        
+        project.last_updated = datetime.utcnow()
+        db.commit()
+
+        _invalidate_caches(project, user.username)
+        
+        return {
+            "success": "true",
+            "message": f"{len(rows)} files processed successfully",
+            "files": [{"path": row["path"], "hash": row["hash"]} for row in rows]
+        }
+        
+    except HTTPException:
+        db.rollback()
+        _queue_rejected_blobs(db, [file_hash for file_hash, _ in stored.values()])
+        raise
+    except Exception as e:
+        db.rollback()
+        _queue_rejected_blobs(db, [file_hash for file_hash, _ in stored.values()])
+        print(f"Error pushing commit: {e}")
+        raise HTTPException(status_code=500, detail=f"Failed to push commit: {str(e)}")
     
 
-@router.post("/pull/{username}/{project_name}")
+@router.post("/push/negotiate")
+def negotiate_push(
+    commit_id: str = Form(...),
+    project_name: str = Form(...),
+    commit_message: str = Form(...),
+    author: str = Form(...),
+    manifest: str = Form(...),
+    user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """
+    Have/want negotiation for a commit. The client posts its manifest of
+    {path, hash, last_updated} entries (hash being the SHA-256 of the content).
+    Entries whose content the server already stores, and deletions, are
+    recorded right away; the response lists the hashes the client still has
+    to upload through /push/file or /push/commit.
+    """
+    try:
+        entries = _parse_manifest(manifest)
+        for entry in entries.values():
+            if entry["hash"] != "DELETED" and not is_sha256(entry["hash"]):
+                raise HTTPException(status_code=400, detail=f"Invalid hash for '{entry['path']}'")
+        
+        project = _get_or_create_project(db, user, project_name)
+        _get_or_create_commit(db, project, commit_id, commit_message, author)
+        project_storage = project_storage_dir(user.username, project_name)
+        
+        rows = []
+        missing = {}
+        for path, entry in entries.items():
+            file_hash = entry["hash"]
+            if file_hash == "DELETED":
+                file_size = 0
+            elif reuse_blob(file_hash):
+                # Marked as reused, so a sweep queued before this push keeps it
+                file_size = blob_size(file_hash)
+            else:
+                missing.setdefault(file_hash, []).append(path)
+                continue
+            rows.append(_apply_file_change(project_storage, commit_id, path, file_hash, file_size, entry["last_updated"]))
+        
+        if rows:
+            _record_file_rows(db, project, commit_id, rows)
+            project.last_updated = datetime.utcnow()
+        db.commit()
+
+        if rows:
+            _invalidate_caches(project, user.username)
+        
+        return {
+            "success": "true",
+            "recorded": [row["path"] for row in rows],
+            "missing": [{"hash": file_hash, "paths": paths} for file_hash, paths in missing.items()]
+        }
+        
+    except HTTPException:
+        db.rollback()
+        raise
+    except Exception as e:
+        db.rollback()
+        print(f"Error negotiating push: {e}")
+        raise HTTPException(status_code=500, detail=f"Failed to negotiate push: {str(e)}")
+    
+
+# Written into incremental pull archives to list deleted paths
+PULL_MANIFEST_NAME = ".pmg-pull.json"
+
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+UPLOAD_SESSION_TTL = timedelta(days=7)
+
+def _merge_ranges(ranges: list[list[int]], start: int, end: int) -> list[list[int]]:
+    merged = []
+    for range_start, range_end in sorted(ranges + [[start, end]]):
+        if merged and range_start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], range_end)
+        else:
+            merged.append([range_start, range_end])
+    return merged
+
+def _missing_ranges(ranges: list[list[int]], size: int) -> list[list[int]]:
+    missing = []
+    position = 0
+    for range_start, range_end in ranges:
+        if range_start > position:
+            missing.append([position, range_start])
+        position = max(position, range_end)
+    if position < size:
+        missing.append([position, size])
+    return missing
+
+def _upload_session_status(session: UploadSession) -> dict:
+    received = json.loads(session.received)
+    return {
+        "session_id": session.id,
+        "path": session.path,
+        "size": session.size,
+        "chunk_size": UPLOAD_CHUNK_SIZE,
+        "received": received,
+        "missing": _missing_ranges(received, session.size)
+    }
+
+async def _get_upload_session(db: AsyncSession, session_id: str, user: User, lock: bool = False) -> UploadSession:
+    query = select(UploadSession).where(UploadSession.id == session_id, UploadSession.user_id == user.id)
+    if lock:
+        # The session may already be in the identity map with stale ranges
+        query = query.with_for_update().execution_options(populate_existing=True)
+    session = await db.scalar(query)
+    if not session:
+        raise HTTPException(status_code=404, detail="Upload session not found")
+    return session
+
+@router.post("/upload/session")
+async def create_upload_session(
+    commit_id: str = Form(...),
+    project_name: str = Form(...),
+    path: str = Form(...),
+    hash: str = Form(...),
+    size: int = Form(...),
+    last_updated: int = Form(...),
+    commit_message: str = Form(...),
+    author: str = Form(...),
+    user: User = Depends(get_current_user_async),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """
+    Starts a resumable upload of one file. Chunks are sent with
+    PUT /upload/session/{id}?offset=N, progress is read back with GET and
+    POST /upload/session/{id}/finalize verifies the hash and records the file.
+    """
+    try:
+        _check_file_path(path)
+        if not is_sha256(hash):
+            raise HTTPException(status_code=400, detail="hash must be the SHA-256 of the file")
+        if size < 0:
+            raise HTTPException(status_code=400, detail="size must not be negative")
+        
+        # Drop this user's abandoned sessions along with their partial files
+        expired = (await db.scalars(select(UploadSession).where(
+            UploadSession.user_id == user.id,
+            UploadSession.created_at < datetime.utcnow() - UPLOAD_SESSION_TTL
+        ))).all()
+        for old_session in expired:
+            await run_in_threadpool(delete_upload_part, old_session.id)
+            await db.delete(old_session)
+        
+        session = UploadSession(
+            id=str(uuid.uuid4()),
+            user_id=user.id,
+            project_name=project_name,
+            commit_id=commit_id,
+            commit_message=commit_message,
+            author=author,
+            path=path,
+            hash=hash,
+            size=size,
+            last_updated=last_updated,
+            received="[]"
+        )
+        await run_in_threadpool(create_upload_part, session.id, size)
+        db.add(session)
+        await db.commit()
+        
+        return _upload_session_status(session)
+    
+    except HTTPException:
+        raise
+    except Exception as e:
+        await db.rollback()
+        print(f"Error creating upload session: {e}")
+        raise HTTPException(status_code=500, detail=f"Failed to create upload session: {str(e)}")
+
+@router.put("/upload/session/{session_id}")
+async def upload_chunk(
+    session_id: str,
+    request: Request,
+    offset: int = Query(..., ge=0),
+    user: User = Depends(get_current_user_async),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """Writes the raw request body at offset. Bytes received before a dropped connection are kept."""
+    try:
+        session = await _get_upload_session(db, session_id, user)
+        size = session.size
+        # End the read transaction so no connection is held while the chunk streams in
+        await db.commit()
+        
+        if offset > size:
+            raise HTTPException(status_code=400, detail="Offset is past the end of the file")
+        
+        written = 0
+        part = await run_in_threadpool(open_upload_part, session_id, offset)
+        try:
+            async for chunk in request.stream():
+                if offset + written + len(chunk) > size:
+                    raise HTTPException(status_code=400, detail="Chunk extends past the end of the file")
+                await run_in_threadpool(part.write, chunk)
+                written += len(chunk)
+        except ClientDisconnect:
+            pass
+        finally:
+            await run_in_threadpool(part.close)
+        
+        # Record the received range under a row lock so concurrent chunks don't lose updates
+        session = await _get_upload_session(db, session_id, user, lock=True)
+        if written:
+            session.received = json.dumps(_merge_ranges(json.loads(session.received), offset, offset + written))
+        await db.commit()
+        
+        return _upload_session_status(session)
+    
+    except HTTPException:
+        raise
+    except Exception as e:
+        await db.rollback()
+        print(f"Error uploading chunk: {e}")
+        raise HTTPException(status_code=500, detail=f"Failed to upload chunk: {str(e)}")
+
+@router.get("/upload/session/{session_id}")
+async def get_upload_session(
+    session_id: str,
+    user: User = Depends(get_current_user_async),
+    db: AsyncSession = Depends(get_async_db)
+):
+    session = await _get_upload_session(db, session_id, user)
+    return _upload_session_status(session)
+
+@router.post("/upload/session/{session_id}/finalize")
+async def finalize_upload_session(
+    session_id: str,
+    user: User = Depends(get_current_user_async),
+    db: AsyncSession = Depends(get_async_db)
+):
+    try:
+        session = await _get_upload_session(db, session_id, user)
+        if _missing_ranges(json.loads(session.received), session.size):
+            raise HTTPException(status_code=409, detail="Upload is incomplete")
+        
+        # Hashing a large part takes a while, so it happens outside any transaction,
+        # without holding a pooled connection or blocking chunks for the session
+        await db.commit()
+        part_path = upload_part_path(session_id)
+        try:
+            part_stat = os.stat(part_path)
+            file_hash, file_size = await run_in_threadpool(hash_path, part_path)
+        except FileNotFoundError:
+            raise HTTPException(status_code=409, detail="Upload is already being finalized")
+        
+        session = await _get_upload_session(db, session_id, user, lock=True)
+        try:
+            changed = os.stat(part_path).st_mtime_ns != part_stat.st_mtime_ns
+        except FileNotFoundError:
+            # Another finalize stored it first
+            raise HTTPException(status_code=409, detail="Upload is already being finalized")
+        if changed:
+            raise HTTPException(status_code=409, detail="Upload changed while it was being finalized")
+        if file_hash != session.hash:
+            # The content can't be trusted for this file; start over
+            await run_in_threadpool(delete_upload_part, session_id)
+            await db.delete(session)
+            await db.commit()
+            raise HTTPException(status_code=400, detail="Uploaded content does not match the expected hash")
+        await run_in_threadpool(store_hashed_path, part_path, file_hash)
+        
+        project = await db.run_sync(_get_or_create_project, user, session.project_name)
+        await db.run_sync(_get_or_create_commit, project, session.commit_id, session.commit_message, session.author)
+        
+        project_storage = project_storage_dir(user.username, session.project_name)
+        await _build_legacy_manifest(db, project)
+        file_record = await run_in_threadpool(_apply_file_change, project_storage, session.commit_id, session.path, file_hash, file_size, session.last_updated)
+        await db.run_sync(_record_file_rows, project, session.commit_id, [file_record])
+        await db.delete(session)
+        
+        project.last_updated = datetime.utcnow()
+        await db.commit()
+
+        await run_in_threadpool(_invalidate_caches, project, user.username)
+        
+        return {
+            "success": "true",
+            "message": "File processed successfully",
+            "file_path": file_record["path"],
+            "hash": file_hash
+        }
+    
+    except HTTPException:
+        raise
+    except Exception as e:
+        await db.rollback()
+        print(f"Error finalizing upload: {e}")
+        raise HTTPException(status_code=500, detail=f"Failed to finalize upload: {str(e)}")
+
+def _head_version(commit_id: str, updated_at: datetime) -> str:
+    # A push may add files to an existing commit, so the head's update time
+    # is part of its version
+    return f"{commit_id}.{updated_at.strftime('%Y%m%d%H%M%S%f')}"
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags or f"W/{etag}" in tags
+
+@router.api_route("/pull/{username}/{project_name}", methods=["GET", "POST"])
 def pull_project(
     username: str,
     project_name: str,
+    since: Optional[str] = Form(None),
+    archive_format: str = Form("zip", alias="format"),
+    level: Optional[int] = Form(None),
+    if_none_match: Optional[str] = Header(None),
     user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
+    """
+    Archives the project's head tree as `format` (zip, tar.gz or tar.zst) at an
+    optional compression `level`. When `since` names a commit of this project
+    that the client already has, only files added or modified after it are
+    included, and a PULL_MANIFEST_NAME member lists the paths deleted since.
+    Full pulls carry an ETag for the head commit, are answered with 304 when
+    the client already has it, and are served from the pull archive cache.
+    """
     try:
+        if archive_format not in ARCHIVE_FORMATS:
+            raise HTTPException(status_code=400, detail=f"Unsupported format, expected one of: {', '.join(ARCHIVE_FORMATS)}")
+        media_type, extension, levels, _ = ARCHIVE_FORMATS[archive_format]
+        if level is not None and level not in levels:
+            raise HTTPException(status_code=400, detail=f"Level for {archive_format} must be between {levels.start} and {levels.stop - 1}")
+        
         project_owner = db.query(User).filter(User.username == username).first()
 
         if not project_owner:
@@ -158,7 +641,8 @@ def pull_project(
         
         project = db.query(Project).filter(
             Project.user_id == project_owner.id,
-            Project.project_name == project_name
+            Project.project_name == project_name,
+            Project.deleted_at.is_(None)
         ).first()
 
         if not project:
@@ -169,34 +653,63 @@ def pull_project(
         if not os.path.exists(project_dir):
             raise HTTPException(status_code=404, detail="Project files not found on server")
         
-        # creating temporary zip file
-        zip_filename = f"{project_name}.zip"
-        zip_filepath = os.path.join("temp", zip_filename)
-        os.makedirs("temp", exist_ok=True)
-
-        # we create zip file ignoring  the .history folder
-        with zipfile.ZipFile(zip_filepath, 'w', zipfile.ZIP_DEFLATED) as zipf:
-            for root,dirs,files in os.walk(project_dir):
-                if '.history' in root.split(os.sep):
-                    continue
-
-                if '.history' in dirs:
-                    dirs.remove('.history')
-
-                for file in files:
-                    file_path = os.path.join(root, file)
-                    arcname = os.path.relpath(file_path, project_dir)
-                    zipf.write(file_path, arcname)
-
-        bg_tasks = BackgroundTasks()
-        bg_tasks.add_task(os.remove, zip_filepath)
-
-        return FileResponse(
-            path=zip_filepath,
-            filename = zip_filename,
-            media_type='application/zip',
-            background=bg_tasks
-        )
+        since_commit = None
+        if since:
+            # Unknown commits fall back to a full pull
+            since_commit = db.query(Commit).filter(
+                Commit.commit_id == since,
+                Commit.project_id == project.id
+            ).first()
+        
+        if ensure_manifest(db, project):
+            db.commit()
+        head = db.get(ProjectHead, project.id)
+        head_commit_id = head.commit_id if head else None
+        
+        headers = {
+            "Content-Disposition": f'attachment; filename="{project_name}{extension}"',
+            "X-PMG-Head-Commit": head_commit_id or "",
+            "X-PMG-Incremental": "true" if since_commit else "false"
+        }
+        
+        cache_key = None
+        if not since_commit and head_commit_id:
+            version = _head_version(head_commit_id, head.updated_at)
+            if archive_format != "zip" or level is not None:
+                # Each format and level is a separate representation
+                version += f".{archive_format}" + (f".{level}" if level is not None else "")
+            etag = f'"{version}"'
+            headers["ETag"] = etag
+            headers["Cache-Control"] = "private, no-cache"
+            if _etag_matches(if_none_match, etag):
+                return Response(status_code=304, headers=headers)
+            
+            cache_key = archive_key(project.id, version)
+            cached_path = get_cached_archive(cache_key)
+            if cached_path:
+                return FileResponse(cached_path, media_type=media_type, headers=headers)
+        
+        if since_commit:
+            entries, deleted = list_changes_since(db, project, since_commit)
+        else:
+            entries, deleted = list_manifest(db, project), []
+        
+        # The archive is streamed as it is built from the head manifest (so .history
+        # is never included); nothing is staged on disk
+        files = [(entry.path, os.path.join(project_dir, entry.path)) for entry in entries]
+        extra = []
+        if since_commit:
+            extra.append((PULL_MANIFEST_NAME, json.dumps({
+                "base_commit_id": since_commit.commit_id,
+                "head_commit_id": head_commit_id,
+                "deleted": deleted
+            }).encode()))
+        
+        body = stream_archive(archive_format, files, extra, level)
+        if cache_key:
+            body = cache_archive_stream(cache_key, body)
+
+        return StreamingResponse(body, media_type=media_type, headers=headers)
     
     except HTTPException:
         raise
@@ -204,37 +717,96 @@ def pull_project(
         print(f"Error pulling project: {e}")
         raise HTTPException(status_code=500, detail=f"Failed to pull project: {str(e)}")
 
+# Upper bound for fetch's wait parameter, and how often a waiting fetch re-reads
+# the head to see pushes handled by other workers
+FETCH_WAIT_MAX = 60
+FETCH_RECHECK_INTERVAL = 5
+
+async def _lookup_head(db: AsyncSession, username: str, project_name: str, use_cache: bool = True) -> dict:
+    """
+    Head commit of a project as {"commit_id", "timestamp", "version"}, from
+    head_cache or a single indexed query. commit_id is None if nothing was pushed.
+    """
+    key = (username, project_name)
+    if use_cache:
+        head = head_cache.get(key)
+        if head:
+            return head
+    
+    query = (
+        select(Project.id, ProjectHead.project_id, ProjectHead.commit_id, ProjectHead.updated_at, Commit.created_at)
+        .join(User, User.id == Project.user_id)
+        .outerjoin(ProjectHead, ProjectHead.project_id == Project.id)
+        .outerjoin(Commit, Commit.commit_id == ProjectHead.commit_id)
+        .where(User.username == username, Project.project_name == project_name, Project.deleted_at.is_(None))
+    )
+    row = (await db.execute(query)).first()
+    
+    if not row:
+        if not await db.scalar(select(User.id).where(User.username == username)):
+            raise HTTPException(status_code=404, detail="Project owner not found")
+        raise HTTPException(status_code=404, detail="Project not found")
+    
+    if row.project_id is None:
+        # Pushed before heads were tracked
+        await run_in_threadpool(build_manifest, row.id)
+        row = (await db.execute(query)).first()
+    
+    # Don't hold a pooled connection while a long-poll waits
+    await db.close()
+    
+    head = {
+        "commit_id": row.commit_id,
+        "timestamp": row.created_at.isoformat() if row.created_at else None,
+        "version": _head_version(row.commit_id, row.updated_at) if row.commit_id else None
+    }
+    head_cache.set(key, head)
+    return head
+
 @router.api_route("/fetch/{username}/{project_name}", methods=["GET", "POST"])
-def fetch_latest_commit(
+async def fetch_latest_commit(
     username: str,
     project_name: str,
-    db: Session = Depends(get_db)
+    response: Response,
+    wait: Optional[float] = Query(None, ge=0),
+    if_none_match: Optional[str] = Header(None),
+    db: AsyncSession = Depends(get_async_db)
 ):
+    """
+    Latest commit of a project, with an ETag for conditional requests.
+    With `wait` (seconds, up to FETCH_WAIT_MAX) the request is held open until
+    the head moves past the one named by If-None-Match, or past the current
+    head when no ETag is sent, and answered with 304 if it doesn't.
+    """
     try:
-        project_owner = db.query(User).filter(User.username == username).first()
-        if not project_owner:
-            raise HTTPException(status_code=404, detail="Project owner not found")
-        
-        project = db.query(Project).filter(
-            Project.user_id == project_owner.id,
-            Project.project_name == project_name
-        ).first()
+        head = await _lookup_head(db, username, project_name)
+        baseline = if_none_match
         
-        if not project:
-            raise HTTPException(status_code=404, detail="Project not found")
+        if wait:
+            key = (username, project_name)
+            baseline = if_none_match or (f'"{head["version"]}"' if head["version"] else None)
+            deadline = asyncio.get_running_loop().time() + min(wait, FETCH_WAIT_MAX)
+            while head["version"] and _etag_matches(baseline, f'"{head["version"]}"'):
+                remaining = deadline - asyncio.get_running_loop().time()
+                if remaining <= 0:
+                    break
+                notified = await head_changes.wait(key, min(remaining, FETCH_RECHECK_INTERVAL))
+                head = await _lookup_head(db, username, project_name, use_cache=notified)
         
-        latest_commit = db.query(Commit).filter(
-            Commit.project_id == project.id
-        ).order_by(Commit.created_at.desc()).first()
-        
-        if not latest_commit:
+        if not head["commit_id"]:
             return {
                 "message": "No commits found for this project"
             }
         
+        etag = f'"{head["version"]}"'
+        if _etag_matches(baseline, etag):
+            return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "no-cache"})
+        
+        response.headers["ETag"] = etag
+        response.headers["Cache-Control"] = "no-cache"
         return {
-            "latest_commit_id": latest_commit.commit_id,
-            "timestamp": latest_commit.created_at.isoformat()
+            "latest_commit_id": head["commit_id"],
+            "timestamp": head["timestamp"]
         }
         
     except HTTPException:
@@ -243,6 +815,32 @@ def fetch_latest_commit(
         print(f"Error fetching latest commit: {e}")
         raise HTTPException(status_code=500, detail=f"Failed to fetch latest commit: {str(e)}")
 
+def _repository_metadata_query(username: str, project_name: str, authorization: Optional[str]):
+    """
+    Everything get_repository shows about a project except its files, in one
+    query: the project, its head and head commit, its RepoDetails and, when an
+    API key is sent, whether that user starred it (star_id).
+    """
+    query = (
+        select(Project, ProjectHead, Commit, RepoDetails)
+        .join(User, User.id == Project.user_id)
+        .outerjoin(ProjectHead, ProjectHead.project_id == Project.id)
+        .outerjoin(Commit, Commit.commit_id == ProjectHead.commit_id)
+        .outerjoin(RepoDetails, RepoDetails.project_id == Project.id)
+        .where(User.username == username, Project.project_name == project_name, Project.deleted_at.is_(None))
+    )
+    if authorization and authorization.startswith("Bearer "):
+        token = authorization.replace("Bearer ", "").strip()
+        viewer = aliased(User)
+        query = (
+            query.add_columns(Star.id.label("star_id"))
+            .outerjoin(viewer, viewer.api_key == token)
+            .outerjoin(Star, and_(Star.project_id == Project.id, Star.user_id == viewer.id))
+        )
+    else:
+        query = query.add_columns(literal(None).label("star_id"))
+    return query
+
 @router.get("/repo/{username}/{project_name}")
 def get_repository(
     username: str,
@@ -250,27 +848,21 @@ def get_repository(
     authorization: Optional[str] = Header(None),
     db: Session = Depends(get_db)
 ):
-    # Run consistency check with cooldown
-    run_consistency_check_if_needed(db)
-    
     try:
-        project_owner = db.query(User).filter(User.username == username).first()
+        query = _repository_metadata_query(username, project_name, authorization)
+        row = db.execute(query).first()
 
-        if not project_owner:
-            raise HTTPException(status_code=404, detail="Project owner not found")
-        
-        project = db.query(Project).filter(
-            Project.user_id == project_owner.id,
-            Project.project_name == project_name
-        ).first()
-
-        if not project:
+        if not row:
+            if not db.query(User.id).filter(User.username == username).first():
+                raise HTTPException(status_code=404, detail="Project owner not found")
             raise HTTPException(status_code=404, detail="Project not found")
         
-        # we will only show latest commit by default
-        latest_commit = db.query(Commit).filter(
-            Commit.project_id == project.id
-        ).order_by(Commit.created_at.desc()).first()
+        if row.ProjectHead is None:
+            # Pushed before heads were tracked
+            if ensure_manifest(db, row.Project):
+                db.commit()
+            row = db.execute(query).first()
+        project, head, latest_commit, repo_details = row.Project, row.ProjectHead, row.Commit, row.RepoDetails
 
         # getting the project directory
         project_dir = os.path.join("storage", "files", username, project_name)
@@ -278,46 +870,22 @@ def get_repository(
         if not os.path.exists(project_dir):
             raise HTTPException(status_code=404, detail="Project files not found on server")
         
-        files = []
-        for root, dirs, file_names in os.walk(project_dir):
-            if '.history' in root.split(os.sep):
-                continue
-
-            if '.history' in dirs:
-                dirs.remove('.history')
-
-            for filename in file_names:
-                file_path = os.path.join(root, filename)
-                relative_path = os.path.relpath(file_path, project_dir).replace(os.sep, '/')
-                files.append({
-                    "path": relative_path,
-                    "size": os.path.getsize(file_path)
-                })
+        files = [{"path": entry.path, "size": entry.size} for entry in list_manifest(db, project)]
 
+        readme_path = resolve_readme(db, head)
+        if db.dirty:
+            db.commit()
+        
         readme_content = None
-        for readme_name in ["README.md", "readme.md", "Readme.md"]:
-            readme_path = os.path.join(project_dir, readme_name)
-            if os.path.exists(readme_path):
-                with open(readme_path, "r", encoding="utf-8") as f:
+        if readme_path:
+            try:
+                with open(os.path.join(project_dir, readme_path), "r", encoding="utf-8") as f:
                     readme_content = f.read()
-                break
+            except FileNotFoundError:
+                pass
         
-        # Get star count
-        repo_details = db.query(RepoDetails).filter(RepoDetails.project_id == project.id).first()
         star_count = repo_details.stars if repo_details else 0
-        
-        # Check if current user has starred
-        is_starred = False
-        if authorization and authorization.startswith("Bearer "):
-            token = authorization.replace("Bearer ", "").strip()
-            current_user = db.query(User).filter(User.api_key == token).first()
-            if current_user:
-                star_exists = db.query(Star).filter(
-                    Star.user_id == current_user.id,
-                    Star.project_id == project.id
-                ).first()
-                if star_exists:
-                    is_starred = True
+        is_starred = row.star_id is not None
 
         return {
             "username": username,
@@ -344,6 +912,243 @@ def get_repository(
         print(f"Error getting repository info: {e}")
         raise HTTPException(status_code=500, detail=f"Failed to get repository info: {str(e)}")
     
+TREE_PAGE_SIZE = 100
+TREE_PAGE_MAX = 1000
+
+def _encode_tree_cursor(kind: str, path: str) -> str:
+    return base64.urlsafe_b64encode(json.dumps([kind, path]).encode()).decode()
+
+def _decode_tree_cursor(cursor: str) -> tuple[str, str]:
+    try:
+        kind, path = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if kind not in ("dir", "file") or not isinstance(path, str):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return kind, path
+
+@router.get("/repo/{username}/{project_name}/tree")
+def get_tree(
+    username: str,
+    project_name: str,
+    path: str = Query(""),
+    cursor: Optional[str] = Query(None),
+    limit: int = Query(TREE_PAGE_SIZE, ge=1, le=TREE_PAGE_MAX),
+    db: Session = Depends(get_db)
+):
+    """
+    Immediate children of one directory of the head tree, subdirectories first.
+    Directories carry their child count and the files and bytes below them.
+    Pass next_cursor back as cursor to get the next page.
+    """
+    try:
+        project_owner = db.query(User).filter(User.username == username).first()
+
+        if not project_owner:
+            raise HTTPException(status_code=404, detail="Project owner not found")
+        
+        project = db.query(Project).filter(
+            Project.user_id == project_owner.id,
+            Project.project_name == project_name,
+            Project.deleted_at.is_(None)
+        ).first()
+
+        if not project:
+            raise HTTPException(status_code=404, detail="Project not found")
+        
+        path = path.strip("/")
+        after = _decode_tree_cursor(cursor) if cursor else None
+        
+        # One extra row tells whether there is another page
+        children = list_directory(db, project, path, after, limit + 1)
+        if children is None:
+            raise HTTPException(status_code=404, detail="Directory not found")
+        
+        entries = []
+        for child in children[:limit]:
+            if isinstance(child, ManifestDirectory):
+                entries.append({
+                    "name": child.path.rpartition("/")[2],
+                    "path": child.path,
+                    "type": "dir",
+                    "size": child.size,
+                    "child_count": child.child_count,
+                    "file_count": child.file_count
+                })
+            else:
+                entries.append({
+                    "name": child.path.rpartition("/")[2],
+                    "path": child.path,
+                    "type": "file",
+                    "size": child.size,
+                    "language": child.language
+                })
+        
+        next_cursor = None
+        if len(children) > limit:
+            last = entries[-1]
+            next_cursor = _encode_tree_cursor(last["type"], last["path"])
+        
+        return {
+            "path": path,
+            "entries": entries,
+            "next_cursor": next_cursor
+        }
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Error listing directory: {e}")
+        raise HTTPException(status_code=500, detail=f"Failed to list directory: {str(e)}")
+
+# Cache lifetime for URLs that name the commit of the content they serve
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+def _blob_response(digest: str, path: str, headers: dict, fallback_path: Optional[str] = None) -> Response:
+    """
+    Serves a stored blob as path's content. Raw blobs are streamed from disk
+    with Range support; packed ones (history only, bounded by PACK_MAX_SIZE)
+    are decoded in memory and sent whole. Files pushed before the object store
+    existed are served from fallback_path.
+    """
+    media_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+    headers = {
+        **headers,
+        # User content is served from the API origin; never let it run as a page there
+        "X-Content-Type-Options": "nosniff",
+        "Content-Security-Policy": "sandbox"
+    }
+    if not has_blob(digest):
+        if not fallback_path or not os.path.isfile(fallback_path):
+            raise HTTPException(status_code=404, detail="File not found")
+        file_path = fallback_path
+    elif is_packed_blob(digest):
+        return Response(read_blob(digest), media_type=media_type, headers=headers)
+    else:
+        file_path = blob_path(digest)
+    return FileResponse(
+        file_path,
+        media_type=media_type,
+        headers=headers,
+        filename=os.path.basename(path),
+        content_disposition_type="inline"
+    )
+
+def _serve_file_at_commit(db: Session, username: str, project_name: str, commit_id: str, path: str, if_none_match: Optional[str]) -> Response:
+    """
+    Serves path as it was at commit_id. Versions at commits older than the head
+    can no longer change, so they are served as immutable; the head commit may
+    still receive files and is revalidated.
+    """
+    row = db.execute(
+        select(Commit, ProjectHead.commit_id)
+        .join(Project, Project.id == Commit.project_id)
+        .join(User, User.id == Project.user_id)
+        .outerjoin(ProjectHead, ProjectHead.project_id == Project.id)
+        .where(
+            User.username == username,
+            Project.project_name == project_name,
+            Project.deleted_at.is_(None),
+            Commit.commit_id == commit_id
+        )
+    ).first()
+
+    if not row:
+        raise HTTPException(status_code=404, detail="Commit not found")
+    commit, head_commit_id = row
+    
+    record = resolve_file_at_commit(db, commit, path)
+    if not record or record.hash == "DELETED":
+        raise HTTPException(status_code=404, detail="File not found at this commit")
+    
+    etag = f'"{record.hash}"'
+    headers = {
+        "ETag": etag,
+        "Cache-Control": "no-cache" if commit_id == head_commit_id else IMMUTABLE_CACHE_CONTROL,
+        "X-PMG-Commit": record.commit_id
+    }
+    if _etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+    
+    fallback_path = None
+    if not has_blob(record.hash):
+        project_storage = project_storage_dir(username, project_name)
+        next_commit_id = next_change_of(db, commit, path)
+        if next_commit_id:
+            fallback_path = os.path.join(project_storage, ".history", next_commit_id, path)
+        else:
+            fallback_path = os.path.join(project_storage, path)
+    return _blob_response(record.hash, path, headers, fallback_path)
+
+@router.get("/repo/{username}/{project_name}/raw/{file_path:path}")
+def get_raw_file(
+    username: str,
+    project_name: str,
+    file_path: str,
+    commit: Optional[str] = Query(None),
+    if_none_match: Optional[str] = Header(None),
+    db: Session = Depends(get_db)
+):
+    """
+    Streams a file of the head tree as is, with its SHA-256 as ETag.
+    With `commit`, streams the file as it was at that commit instead.
+    """
+    try:
+        if commit:
+            return _serve_file_at_commit(db, username, project_name, commit, file_path, if_none_match)
+        
+        entry = db.scalar(
+            select(ManifestEntry)
+            .join(Project, Project.id == ManifestEntry.project_id)
+            .join(User, User.id == Project.user_id)
+            .where(
+                User.username == username,
+                Project.project_name == project_name,
+                Project.deleted_at.is_(None),
+                ManifestEntry.path == file_path
+            )
+        )
+
+        if not entry:
+            raise HTTPException(status_code=404, detail="File not found")
+        
+        etag = f'"{entry.hash}"'
+        headers = {
+            "ETag": etag,
+            "Cache-Control": "no-cache",
+            "X-PMG-Commit": entry.commit_id or ""
+        }
+        if _etag_matches(if_none_match, etag):
+            return Response(status_code=304, headers=headers)
+        
+        working_path = os.path.join(project_storage_dir(username, project_name), entry.path)
+        return _blob_response(entry.hash, entry.path, headers, working_path)
+    
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Error getting raw file: {e}")
+        raise HTTPException(status_code=500, detail=f"Failed to get file: {str(e)}")
+
+@router.get("/repo/{username}/{project_name}/commits/{commit_id}/file/{file_path:path}")
+def get_file_at_commit(
+    username: str,
+    project_name: str,
+    commit_id: str,
+    file_path: str,
+    if_none_match: Optional[str] = Header(None),
+    db: Session = Depends(get_db)
+):
+    """Streams a file as it was at any commit of the project."""
+    try:
+        return _serve_file_at_commit(db, username, project_name, commit_id, file_path, if_none_match)
+    
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Error getting file at commit: {e}")
+        raise HTTPException(status_code=500, detail=f"Failed to get file: {str(e)}")
+
 @router.get("/repo/{username}/{project_name}/file/{file_path:path}")
 def get_file(
     username: str,
@@ -377,12 +1182,31 @@ def get_file(
         print(f"Error getting file: {e}")
         raise HTTPException(status_code=500, detail=f"Failed to get file: {str(e)}")
     
+COMMITS_PAGE_SIZE = 50
+COMMITS_PAGE_MAX = 500
+
+def _encode_commit_cursor(created_at: datetime, commit_pk: int) -> str:
+    return base64.urlsafe_b64encode(json.dumps([created_at.isoformat(), commit_pk]).encode()).decode()
+
+def _decode_commit_cursor(cursor: str) -> tuple[datetime, int]:
+    try:
+        created_at, commit_pk = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return datetime.fromisoformat(created_at), int(commit_pk)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
 @router.get("/repo/{username}/{project_name}/commits")
 def list_commits(
     username: str,
     project_name: str,
+    cursor: Optional[str] = Query(None),
+    limit: int = Query(COMMITS_PAGE_SIZE, ge=1, le=COMMITS_PAGE_MAX),
     db: Session = Depends(get_db)
 ):
+    """
+    Commits newest first, one page at a time, with the number of files and
+    bytes each pushed. Pass next_cursor back as cursor to get the next page.
+    """
     try:
         project_owner = db.query(User).filter(User.username == username).first()
 
@@ -391,28 +1215,56 @@ def list_commits(
         
         project = db.query(Project).filter(
             Project.user_id == project_owner.id,
-            Project.project_name == project_name
+            Project.project_name == project_name,
+            Project.deleted_at.is_(None)
         ).first()
 
         if not project:
             raise HTTPException(status_code=404, detail="Project not found")
         
-        commits = db.query(Commit).filter(
-            Commit.project_id == project.id
-        ).order_by(Commit.created_at.desc()).all()
+        # The page is cut from the (project_id, created_at, id) index first, so
+        # only its commits are joined to their file records
+        page = select(Commit).where(Commit.project_id == project.id)
+        if cursor:
+            page = page.where(tuple_(Commit.created_at, Commit.id) < _decode_commit_cursor(cursor))
+        # One extra row tells whether there is another page
+        page = page.order_by(Commit.created_at.desc(), Commit.id.desc()).limit(limit + 1).subquery()
+        
+        rows = db.execute(
+            select(
+                page.c.id,
+                page.c.commit_id,
+                page.c.commit_message,
+                page.c.author,
+                page.c.created_at,
+                func.count(FileRecord.id).label("file_count"),
+                func.coalesce(func.sum(FileRecord.file_size), 0).label("total_bytes")
+            )
+            .outerjoin(FileRecord, FileRecord.commit_id == page.c.commit_id)
+            .group_by(page.c.id, page.c.commit_id, page.c.commit_message, page.c.author, page.c.created_at)
+            .order_by(page.c.created_at.desc(), page.c.id.desc())
+        ).all()
         
         commit_list = []
-        for commit in commits:
+        for commit in rows[:limit]:
             commit_list.append({
                 "id": commit.commit_id,
                 "message": commit.commit_message,
                 "author": commit.author,
-                "date": commit.created_at.isoformat()
+                "date": commit.created_at.isoformat(),
+                "file_count": commit.file_count,
+                "total_bytes": int(commit.total_bytes)
             })
         
+        next_cursor = None
+        if len(rows) > limit:
+            last = rows[limit - 1]
+            next_cursor = _encode_commit_cursor(last.created_at, last.id)
+        
         return {
             "project_name": project_name,
-            "commits": commit_list
+            "commits": commit_list,
+            "next_cursor": next_cursor
         }
     
     except HTTPException:
@@ -436,7 +1288,8 @@ def get_languages_list(
         
         project = db.query(Project).filter(
             Project.user_id == project_owner.id,
-            Project.project_name == project_name
+            Project.project_name == project_name,
+            Project.deleted_at.is_(None)
         ).first()
 
         if not project:
@@ -447,42 +1300,17 @@ def get_languages_list(
         if not os.path.exists(project_dir):
             raise HTTPException(status_code=404, detail="Project files not found on server")
         
-        language_extensions = {
-            '.py': 'Python',
-            '.js': 'JavaScript',
-            '.ts': 'TypeScript',
-            '.java': 'Java',
-            '.cpp': 'C++',
-            '.c': 'C',
-            '.cs': 'C#',
-            '.rb': 'Ruby',
-            '.go': 'Go',
-            '.php': 'PHP',
-            '.rs': 'Rust',
-            '.swift': 'Swift',
-            '.kt': 'Kotlin',
-            '.m': 'Objective-C',
-        }
+        built = ensure_manifest(db, project)
+        built = ensure_language_stats(db, project) or built
+        if built:
+            db.commit()
         
-        language_stats = {}
-        total_size = 0
-        
-        for root, dirs, files in os.walk(project_dir):
-            if '.history' in root.split(os.sep):
-                continue
-
-            if '.history' in dirs:
-                dirs.remove('.history')
-
-            for filename in files:
-                file_path = os.path.join(root, filename)
-                ext = os.path.splitext(filename)[1]
-                size = os.path.getsize(file_path)
-                
-                if ext in language_extensions:
-                    lang = language_extensions[ext]
-                    language_stats[lang] = language_stats.get(lang, 0) + size
-                    total_size += size
+        language_stats = {lang: int(size) for lang, size in db.execute(
+            select(LanguageStat.language, LanguageStat.bytes)
+            .where(LanguageStat.project_id == project.id, LanguageStat.bytes > 0)
+            .order_by(LanguageStat.bytes.desc())
+        ).all()}
+        total_size = sum(language_stats.values())
         
         # Calculate percentages
         for lang in language_stats:
@@ -514,44 +1342,19 @@ def star_repository(
         
         project = db.query(Project).filter(
             Project.user_id == project_owner.id,
-            Project.project_name == project_name
+            Project.project_name == project_name,
+            Project.deleted_at.is_(None)
         ).first()
 
         if not project:
             raise HTTPException(status_code=404, detail="Project not found")
         
-        # Check if already starred
-        existing_star = db.query(Star).filter(
-            Star.user_id == user.id,
-            Star.project_id == project.id
-        ).first()
-        
-        repo_details = db.query(RepoDetails).filter(RepoDetails.project_id == project.id).first()
-        if not repo_details:
-            repo_details = RepoDetails(project_id=project.id, stars=0)
-            db.add(repo_details)
-            db.flush() # flush to get ID if needed, though we have project_id
-
-        is_starred = False
-        if existing_star:
-            # Unstar
-            db.delete(existing_star)
-            repo_details.stars = max(0, repo_details.stars - 1)
-            message = "Repository unstarred successfully"
-            is_starred = False
-        else:
-            # Star
-            new_star = Star(user_id=user.id, project_id=project.id)
-            db.add(new_star)
-            repo_details.stars += 1
-            message = "Repository starred successfully"
-            is_starred = True
-        
+        is_starred, total_stars = toggle_star(db, user.id, project.id)
         db.commit()
         
         return {
-            "message": message,
-            "total_stars": repo_details.stars,
+            "message": "Repository starred successfully" if is_starred else "Repository unstarred successfully",
+            "total_stars": total_stars,
             "is_starred": is_starred
         }
     
@@ -561,6 +1364,55 @@ def star_repository(
         print(f"Error starring repository: {e}")
         raise HTTPException(status_code=500, detail=f"Failed to star repository: {str(e)}")
 
+@router.post("/starred")
+def get_starred_projects(
+    projects: str = Form(...),
+    user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """
+    Tells which of a list of projects the current user has starred, so list
+    views can mark their cards with one request. projects is a JSON list of
+    "username/project_name" strings.
+    """
+    try:
+        try:
+            names = json.loads(projects)
+            if not isinstance(names, list):
+                raise TypeError("projects must be a list")
+            refs = [tuple(name.split("/", 1)) for name in names]
+        except (ValueError, TypeError, AttributeError):
+            raise HTTPException(status_code=400, detail="projects must be a JSON list of \"username/project_name\" strings")
+        if any(len(ref) != 2 for ref in refs):
+            raise HTTPException(status_code=400, detail="projects must be a JSON list of \"username/project_name\" strings")
+        if len(refs) > STARRED_LOOKUP_MAX:
+            raise HTTPException(status_code=400, detail=f"At most {STARRED_LOOKUP_MAX} projects can be looked up at once")
+        
+        starred = starred_projects(db, user.id, refs)
+        return {
+            "starred": [f"{username}/{project_name}" for username, project_name in refs if (username, project_name) in starred]
+        }
+    
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Error looking up starred projects: {e}")
+        raise HTTPException(status_code=500, detail=f"Failed to look up starred projects: {str(e)}")
+
+def _deployment_info(username: str, project_name: str, deployment: Deployment, active_id: Optional[int]) -> dict:
+    return {
+        "snapshot_id": deployment.snapshot_id,
+        "commit_id": deployment.commit_id,
+        "source_path": deployment.source_path,
+        "file_count": deployment.file_count,
+        "size": deployment.size,
+        "created_at": deployment.created_at.isoformat(),
+        "active": deployment.id == active_id,
+        # Served with an immutable cache policy for as long as the snapshot is kept; relative
+        # asset URLs resolve inside the snapshot too
+        "snapshot_url": f"/pages/{username}/{project_name}/@{deployment.snapshot_id}/{deployment.source_path}"
+    }
+
 @router.post("/deploy/{username}/{project_name}")
 def deploy_project(
     username: str,
@@ -576,32 +1428,37 @@ def deploy_project(
             
         project = db.query(Project).filter(
             Project.user_id == user.id,
-            Project.project_name == project_name
+            Project.project_name == project_name,
+            Project.deleted_at.is_(None)
         ).first()
         
         if not project:
             raise HTTPException(status_code=404, detail="Project not found")
             
-        repo_details = db.query(RepoDetails).filter(RepoDetails.project_id == project.id).first()
+        deployment = create_deployment(db, project, source_path)
+        if not deployment:
+            raise HTTPException(status_code=400, detail=f"Source file '{source_path}' does not exist")
+        project_id, deployment_id = project.id, deployment.id
+        db.commit()
         
-        if not repo_details:
-            repo_details = RepoDetails(project_id=project.id)
-            db.add(repo_details)
-            
-        # Verify source file exists
-        project_dir = os.path.join("storage", "files", username, project_name)
-        full_source_path = os.path.join(project_dir, source_path)
+        # Pin the site's blobs and build the gzip and brotli variants of its text assets before it goes live
+        files = db.query(DeploymentFile.path, DeploymentFile.hash, DeploymentFile.size).filter(
+            DeploymentFile.deployment_id == deployment_id
+        ).all()
+        db.close()
+        link_deployment(deployment_id, files)
+        precompress_files(files)
         
-        if not os.path.exists(full_source_path):
-            raise HTTPException(status_code=400, detail=f"Source file '{source_path}' does not exist")
-            
-        repo_details.isDeployed = True
-        repo_details.deploy_source_path = source_path
+        deployment = db.get(Deployment, deployment_id)
+        activate_deployment(db, project_id, deployment)
+        prune_deployments(db, project_id)
         db.commit()
+        deployment_changed(username, project_name)
         
         return {
             "message": "Project deployed successfully",
-            "deployment_url": f"/pages/{username}/{project_name}"
+            "deployment_url": f"/pages/{username}/{project_name}",
+            "deployment": _deployment_info(username, project_name, deployment, deployment.id)
         }
         
     except HTTPException:
@@ -624,7 +1481,8 @@ def undeploy_project(
             
         project = db.query(Project).filter(
             Project.user_id == user.id,
-            Project.project_name == project_name
+            Project.project_name == project_name,
+            Project.deleted_at.is_(None)
         ).first()
         
         if not project:
@@ -635,6 +1493,7 @@ def undeploy_project(
         if repo_details:
             repo_details.isDeployed = False
             db.commit()
+        deployment_changed(username, project_name)
             
         return {
             "message": "Project undeployed successfully"
@@ -646,6 +1505,93 @@ def undeploy_project(
         print(f"Error undeploying project: {e}")
         raise HTTPException(status_code=500, detail=f"Failed to undeploy project: {str(e)}")
 
+@router.get("/deployments/{username}/{project_name}")
+def list_deployments(
+    username: str,
+    project_name: str,
+    user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    try:
+        # Verify ownership
+        if user.username != username:
+            raise HTTPException(status_code=403, detail="Only the project owner can list deployments")
+            
+        project = db.query(Project).filter(
+            Project.user_id == user.id,
+            Project.project_name == project_name,
+            Project.deleted_at.is_(None)
+        ).first()
+        
+        if not project:
+            raise HTTPException(status_code=404, detail="Project not found")
+        
+        active_id = db.scalar(select(RepoDetails.deployment_id).where(
+            RepoDetails.project_id == project.id,
+            RepoDetails.isDeployed == True
+        ))
+        deployments = db.query(Deployment).filter(
+            Deployment.project_id == project.id
+        ).order_by(Deployment.created_at.desc(), Deployment.id.desc()).all()
+        
+        return {
+            "project_name": project_name,
+            "deployments": [_deployment_info(username, project_name, deployment, active_id) for deployment in deployments]
+        }
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Error listing deployments: {e}")
+        raise HTTPException(status_code=500, detail=f"Failed to list deployments: {str(e)}")
+
+@router.post("/rollback/{username}/{project_name}")
+def rollback_deployment(
+    username: str,
+    project_name: str,
+    snapshot_id: str = Form(...),
+    user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Makes an earlier deployment live again. Nothing is rebuilt, so the switch is instant."""
+    try:
+        # Verify ownership
+        if user.username != username:
+            raise HTTPException(status_code=403, detail="Only the project owner can roll back")
+            
+        project = db.query(Project).filter(
+            Project.user_id == user.id,
+            Project.project_name == project_name,
+            Project.deleted_at.is_(None)
+        ).first()
+        
+        if not project:
+            raise HTTPException(status_code=404, detail="Project not found")
+        
+        deployment = db.query(Deployment).filter(
+            Deployment.project_id == project.id,
+            Deployment.snapshot_id == snapshot_id
+        ).first()
+        
+        if not deployment:
+            raise HTTPException(status_code=404, detail="Deployment not found")
+        
+        activate_deployment(db, project.id, deployment)
+        db.commit()
+        deployment_changed(username, project_name)
+        
+        return {
+            "message": "Deployment rolled back successfully",
+            "deployment_url": f"/pages/{username}/{project_name}",
+            "deployment": _deployment_info(username, project_name, deployment, deployment.id)
+        }
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Error rolling back deployment: {e}")
+        raise HTTPException(status_code=500, detail=f"Failed to roll back deployment: {str(e)}")
+
 @router.post("/fork/{username}/{project_name}")
 def fork_repository(
     username: str,
@@ -661,7 +1607,8 @@ def fork_repository(
         
         original_project = db.query(Project).filter(
             Project.user_id == project_owner.id,
-            Project.project_name == project_name
+            Project.project_name == project_name,
+            Project.deleted_at.is_(None)
         ).first()
 
         if not original_project:
@@ -671,7 +1618,8 @@ def fork_repository(
         forked_project_name = f"{project_name}-fork"
         existing_fork = db.query(Project).filter(
             Project.user_id == user.id,
-            Project.project_name == forked_project_name
+            Project.project_name == forked_project_name,
+            Project.deleted_at.is_(None)
         ).first()
         
         if existing_fork:
@@ -684,12 +1632,18 @@ def fork_repository(
         db.add(forked_project)
         db.flush()
         
-        # Copy files in storage
+        # History is copied in bulk SQL and files are shared as hardlinks; each
+        # side copies on write when it pushes, since pushes only replace files
         original_dir = os.path.join("storage", "files", username, project_name)
         forked_dir = os.path.join("storage", "files", user.username, forked_project_name)
-        shutil.copytree(original_dir, forked_dir)
-        
-        db.commit()
+        commit_ids = copy_project_records(db, original_project, forked_project, original_dir, forked_dir)
+        try:
+            link_project_tree(original_dir, forked_dir, commit_ids)
+            db.commit()
+        except Exception:
+            shutil.rmtree(forked_dir, ignore_errors=True)
+            raise
+        _invalidate_latest_repos_cache()
         
         return {
             "message": "Repository forked successfully",
@@ -702,10 +1656,11 @@ def fork_repository(
         print(f"Error forking repository: {e}")
         raise HTTPException(status_code=500, detail=f"Failed to fork repository: {str(e)}")
     
-@router.delete("/delete_repo/{username}/{project_name}")
+@router.delete("/delete_repo/{username}/{project_name}", status_code=202)
 def delete_repository(
     username: str,
     project_name: str,
+    background_tasks: BackgroundTasks,
     user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
@@ -716,34 +1671,97 @@ def delete_repository(
             
         project = db.query(Project).filter(
             Project.user_id == user.id,
-            Project.project_name == project_name
+            Project.project_name == project_name,
+            Project.deleted_at.is_(None)
         ).first()
         
         if not project:
             raise HTTPException(status_code=404, detail="Project not found")
         
-        # Delete project files
-        project_dir = os.path.join("storage", "files", username, project_name)
-        if os.path.exists(project_dir):
-            shutil.rmtree(project_dir)
-        
-        # Delete database records
-        db.query(Star).filter(Star.project_id == project.id).delete()
-        db.query(RepoDetails).filter(RepoDetails.project_id == project.id).delete()
-        db.query(FileRecord).filter(FileRecord.commit_id.in_(
-            db.query(Commit.commit_id).filter(Commit.project_id == project.id)
-        )).delete(synchronize_session=False)
-        db.query(Commit).filter(Commit.project_id == project.id).delete()
-        db.delete(project)
-        
-        db.commit()
+        # The project disappears from reads now; the reaper removes its rows and files
+        deletion = tombstone_project(db, project, username)
+        try:
+            db.commit()
+        except Exception:
+            restore_from_trash(deletion, username)
+            raise
+        _invalidate_latest_repos_cache()
+        head_changed(username, project_name)
+        deployment_changed(username, project_name)
+        invalidate_project_archives(deletion.project_id)
+        background_tasks.add_task(reap_deletions)
         
         return {
-            "message": "Repository deleted successfully"
+            "message": "Repository scheduled for deletion",
+            "deletion_id": deletion.id,
+            "status_url": f"/api/deletions/{deletion.id}"
         }
         
     except HTTPException:
         raise
     except Exception as e:
         print(f"Error deleting repository: {e}")
-        raise HTTPException(status_code=500, detail=f"Failed to delete repository: {str(e)}")
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=f"Failed to delete repository: {str(e)}")
+
+@router.get("/deletions/{deletion_id}")
+def get_deletion_status(
+    deletion_id: int,
+    user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    try:
+        deletion = db.query(ProjectDeletion).filter(
+            ProjectDeletion.id == deletion_id,
+            ProjectDeletion.user_id == user.id
+        ).first()
+        
+        if not deletion:
+            raise HTTPException(status_code=404, detail="Deletion not found")
+        
+        return {
+            "deletion_id": deletion.id,
+            "project_name": deletion.project_name,
+            "status": deletion.status,
+            "phase": deletion.phase,
+            "files_removed": deletion.files_removed,
+            "rows_deleted": deletion.rows_deleted,
+            "error": deletion.error,
+            "created_at": deletion.created_at.isoformat(),
+            "finished_at": deletion.finished_at.isoformat() if deletion.finished_at else None
+        }
+    
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Error getting deletion status: {e}")
+        raise HTTPException(status_code=500, detail=f"Failed to get deletion status: {str(e)}")
+
+@router.get("/consistency")
+def get_consistency_status(
+    db: Session = Depends(get_db)
+):
+    """Reports the latest run of the background consistency checker."""
+    try:
+        run = db.query(ConsistencyRun).order_by(ConsistencyRun.started_at.desc()).first()
+        
+        if not run:
+            return {"last_run": None}
+        
+        return {
+            "last_run": {
+                "started_at": run.started_at.isoformat(),
+                "finished_at": run.finished_at.isoformat() if run.finished_at else None,
+                "duration_ms": run.duration_ms,
+                "checked_since": run.checked_since.isoformat() if run.checked_since else None,
+                "projects_checked": run.projects_checked,
+                "files_checked": run.files_checked,
+                "projects_removed": run.projects_removed,
+                "file_records_removed": run.file_records_removed,
+                "findings": json.loads(run.findings),
+                "error": run.error
+            }
+        }
+    
+    except Exception as e:
+        print(f"Error getting consistency status: {e}")
+        raise HTTPException(status_code=500, detail=f"Failed to get consistency status: {str(e)}")
@@ -0,0 +1,55 @@
+from sqlalchemy import delete, func, select, tuple_
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+from .models import User, Project, Star, RepoDetails
+
+# Most projects a single starred lookup may ask about
+STARRED_LOOKUP_MAX = 500
+
+
+def toggle_star(db: Session, user_id: int, project_id: int) -> tuple[bool, int]:
+    """
+    Stars the project for the user, or unstars it if already starred, and
+    returns (is_starred, total_stars). The Star row is the source of truth and
+    the counter is adjusted in the database, so concurrent stars of the same
+    project never overwrite each other. Runs in the caller's transaction.
+    """
+    removed = db.execute(
+        delete(Star)
+        .where(Star.user_id == user_id, Star.project_id == project_id)
+        .returning(Star.id)
+    ).first()
+
+    if removed:
+        is_starred, delta = False, -1
+    else:
+        added = db.execute(
+            insert(Star)
+            .values(user_id=user_id, project_id=project_id)
+            .on_conflict_do_nothing(constraint="unique_user_project_star")
+            .returning(Star.id)
+        ).first()
+        # A concurrent request of the same user may have starred it first
+        is_starred, delta = True, 1 if added else 0
+
+    stmt = insert(RepoDetails).values(project_id=project_id, stars=max(delta, 0))
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[RepoDetails.project_id],
+        set_={"stars": func.greatest(RepoDetails.stars + delta, 0)},
+    ).returning(RepoDetails.stars)
+    total_stars = db.execute(stmt).scalar_one()
+    return is_starred, total_stars
+
+
+def starred_projects(db: Session, user_id: int, refs: list[tuple[str, str]]) -> set[tuple[str, str]]:
+    """Returns the (username, project_name) pairs among refs that the user has starred, in one query."""
+    if not refs:
+        return set()
+    rows = db.execute(
+        select(User.username, Project.project_name)
+        .select_from(Star)
+        .join(Project, Project.id == Star.project_id)
+        .join(User, User.id == Project.user_id)
+        .where(Star.user_id == user_id, tuple_(User.username, Project.project_name).in_(refs))
+    )
+    return {(username, project_name) for username, project_name in rows}
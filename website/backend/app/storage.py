@@ -0,0 +1,413 @@
+import os
+import re
+import fcntl
+import shutil
+import hashlib
+import uuid
+from contextlib import contextmanager
+from typing import Iterator
+
+import anyio.to_thread
+
+from . import packing
+
+STORAGE_ROOT = "storage"
+FILES_DIR = os.path.join(STORAGE_ROOT, "files")
+OBJECTS_DIR = os.path.join(STORAGE_ROOT, "objects")
+TMP_DIR = os.path.join(STORAGE_ROOT, "tmp")
+UPLOADS_DIR = os.path.join(TMP_DIR, "uploads")
+LOCKS_DIR = os.path.join(STORAGE_ROOT, "locks")
+CHUNK_SIZE = 1024 * 1024
+SHA256_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+
+# How superseded versions are kept: "none" leaves them as raw blobs, "zlib"
+# compresses them and "delta" stores them relative to the version that replaced them
+HISTORY_ENCODING = os.getenv("HISTORY_ENCODING", "none").lower()
+PACK_MAX_SIZE = 64 * 1024 * 1024
+# Compaction runs inside pushes and line deltas get slow on large files, so
+# versions above this size are zlib-compressed instead
+DELTA_MAX_SIZE = int(os.getenv("DELTA_MAX_SIZE", str(1024 * 1024)))
+
+
+def project_storage_dir(username: str, project_name: str) -> str:
+    return os.path.join(FILES_DIR, username, project_name)
+
+
+def blob_path(digest: str) -> str:
+    """
+    Location of a blob in the content-addressed object store.
+    Blobs are fanned out by the first two hex characters of their SHA-256.
+    """
+    return os.path.join(OBJECTS_DIR, digest[:2], digest[2:])
+
+
+@contextmanager
+def blob_lock(digest: str, exclusive: bool = False) -> Iterator[None]:
+    """
+    Guards a blob's inode in the object store. Holders of the shared lock may
+    link or unpack the blob; only the exclusive holder may replace or remove
+    it. Locks are flock()s striped by the first byte of the hash, so they hold
+    across worker processes. They must not be nested.
+    """
+    os.makedirs(LOCKS_DIR, exist_ok=True)
+    fd = os.open(os.path.join(LOCKS_DIR, digest[:2]), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        yield
+    finally:
+        os.close(fd)
+
+
+def is_sha256(value: str) -> bool:
+    return bool(SHA256_PATTERN.match(value))
+
+
+def has_blob(digest: str) -> bool:
+    return is_sha256(digest) and os.path.exists(blob_path(digest))
+
+
+def new_temp_path() -> str:
+    # Temp files live on the storage volume so renames into place stay atomic
+    os.makedirs(TMP_DIR, exist_ok=True)
+    return os.path.join(TMP_DIR, uuid.uuid4().hex)
+
+
+class BlobWriter:
+    """
+    Streams content into a temp file on the storage volume while hashing it,
+    so memory use stays constant regardless of file size. commit() renames the
+    temp file into the object store under its SHA-256.
+    """
+
+    def __init__(self):
+        self.tmp_path = new_temp_path()
+        self.size = 0
+        self._hasher = hashlib.sha256()
+        self._file = open(self.tmp_path, "wb")
+
+    def write(self, chunk: bytes) -> None:
+        self._hasher.update(chunk)
+        self._file.write(chunk)
+        self.size += len(chunk)
+
+    def commit(self) -> str:
+        self._file.close()
+        digest = self._hasher.hexdigest()
+        store_hashed_path(self.tmp_path, digest)
+        return digest
+
+    def discard(self) -> None:
+        self._file.close()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+
+def store_blob_from_file(fileobj) -> tuple[str, int]:
+    """Stores a file-like object's content in chunks. Returns (sha256, size)."""
+    writer = BlobWriter()
+    try:
+        while chunk := fileobj.read(CHUNK_SIZE):
+            writer.write(chunk)
+        return writer.commit(), writer.size
+    except BaseException:
+        writer.discard()
+        raise
+
+
+async def store_upload(upload) -> tuple[str, int]:
+    """
+    Async counterpart of store_blob_from_file for UploadFile. Returns (sha256, size).
+    Disk writes run in worker threads so the event loop is never blocked.
+    """
+    writer = await anyio.to_thread.run_sync(BlobWriter)
+    try:
+        while chunk := await upload.read(CHUNK_SIZE):
+            await anyio.to_thread.run_sync(writer.write, chunk)
+        return await anyio.to_thread.run_sync(writer.commit), writer.size
+    except BaseException:
+        writer.discard()
+        raise
+
+
+def hash_path(path: str) -> tuple[str, int]:
+    """Returns the (sha256, size) of a file, hashed in chunks."""
+    hasher = hashlib.sha256()
+    size = 0
+    with open(path, "rb") as f:
+        while chunk := f.read(CHUNK_SIZE):
+            hasher.update(chunk)
+            size += len(chunk)
+    return hasher.hexdigest(), size
+
+
+def store_blob_from_path(path: str) -> tuple[str, int]:
+    """
+    Moves a finished file on the storage volume into the object store.
+    Returns (sha256, size); the file is hashed in chunks.
+    """
+    digest, size = hash_path(path)
+    store_hashed_path(path, digest)
+    return digest, size
+
+
+def store_hashed_path(path: str, digest: str) -> None:
+    """Moves a file already known to hash to digest into the object store."""
+    target = blob_path(digest)
+    with blob_lock(digest):
+        if os.path.exists(target):
+            # Content is already stored
+            _mark_reused(target)
+            os.remove(path)
+        else:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.replace(path, target)
+
+
+def _mark_reused(target: str) -> None:
+    # Bumps the inode's ctime, leaving its times as they were, so a queued sweep keeps the blob
+    stat = os.stat(target)
+    os.utime(target, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+
+def reuse_blob(digest: str) -> bool:
+    """has_blob for content that is about to be linked: also keeps a queued sweep from removing it."""
+    if not is_sha256(digest):
+        return False
+    with blob_lock(digest):
+        try:
+            _mark_reused(blob_path(digest))
+        except FileNotFoundError:
+            return False
+    return True
+
+
+def remove_unused_blob(digest: str, unused_since: float) -> bool:
+    """
+    Removes a blob that nothing links to, unless it was stored, linked or
+    reused after the unused_since timestamp. The caller makes sure no rows
+    refer to it. Returns whether it was removed.
+    """
+    if not is_sha256(digest):
+        return False
+    with blob_lock(digest, exclusive=True):
+        try:
+            stat = os.stat(blob_path(digest))
+        except FileNotFoundError:
+            return False
+        if stat.st_nlink > 1 or stat.st_ctime > unused_since:
+            return False
+        os.remove(blob_path(digest))
+    return True
+
+
+def upload_part_path(session_id: str) -> str:
+    return os.path.join(UPLOADS_DIR, session_id)
+
+
+def create_upload_part(session_id: str, size: int) -> None:
+    """Creates the (sparse) file that a resumable upload's chunks are written into."""
+    os.makedirs(UPLOADS_DIR, exist_ok=True)
+    with open(upload_part_path(session_id), "wb") as f:
+        f.truncate(size)
+
+
+def open_upload_part(session_id: str, offset: int):
+    """Opens a resumable upload's file for writing a chunk at offset."""
+    f = open(upload_part_path(session_id), "r+b")
+    f.seek(offset)
+    return f
+
+
+def delete_upload_part(session_id: str) -> None:
+    if os.path.exists(upload_part_path(session_id)):
+        os.remove(upload_part_path(session_id))
+
+
+def link_file(source: str, dest: str) -> None:
+    """
+    Atomically places a hardlink to source at dest, replacing whatever was there.
+    Falls back to a copy when hardlinks are not possible (other device, link limit).
+    Files placed this way share their inode with the blob, so they must only ever
+    be replaced, never written in place.
+    """
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    tmp_path = new_temp_path()
+    try:
+        os.link(source, tmp_path)
+    except OSError:
+        shutil.copy2(source, tmp_path)
+    os.replace(tmp_path, dest)
+
+
+def link_project_tree(source_dir: str, dest_dir: str, history_names: dict[str, str]) -> None:
+    """
+    Recreates a project directory, working tree and .history, as hardlinks to
+    the source's files, so no content is copied. .history/<commit_id>/ entries
+    are placed under history_names[commit_id]. Both trees only ever replace
+    their files, so each side's later pushes leave the other untouched.
+    """
+    os.makedirs(dest_dir, exist_ok=True)
+    for root, dirs, file_names in os.walk(source_dir):
+        relative_root = os.path.relpath(root, source_dir)
+        parts = [] if relative_root == "." else relative_root.split(os.sep)
+        if len(parts) >= 2 and parts[0] == ".history":
+            parts[1] = history_names.get(parts[1], parts[1])
+        dest_root = os.path.join(dest_dir, *parts)
+        os.makedirs(dest_root, exist_ok=True)
+        for filename in file_names:
+            source = os.path.join(root, filename)
+            dest = os.path.join(dest_root, filename)
+            try:
+                os.link(source, dest)
+            except OSError:
+                shutil.copy2(source, dest)
+
+
+def checkout_blob(digest: str, dest: str) -> None:
+    """Makes dest (a working tree or history path) point at a stored blob."""
+    # Compaction can't swap in a packed copy between unpacking and linking
+    with blob_lock(digest):
+        _unpack_blob(digest)
+        link_file(blob_path(digest), dest)
+
+
+def _read_pack_header(path: str) -> dict | None:
+    with open(path, "rb") as f:
+        return packing.parse_header(f.read(packing.DELTA_HEADER_LENGTH))
+
+
+def read_stored_file(path: str) -> bytes:
+    """
+    Reads a blob or history entry, reconstructing it if it was packed.
+    Delta chains are followed iteratively down to a raw or zlib base.
+    """
+    chain = []
+    while True:
+        with open(path, "rb") as f:
+            data = f.read()
+        header = packing.parse_header(data[:packing.DELTA_HEADER_LENGTH])
+        if not header or header["kind"] != "delta" or not has_blob(header["base"]):
+            break
+        chain.append(data)
+        path = blob_path(header["base"])
+
+    content = packing.decode(data)
+    for data in reversed(chain):
+        content = packing.decode(data, content)
+    return content
+
+
+def read_blob(digest: str) -> bytes:
+    return read_stored_file(blob_path(digest))
+
+
+def read_history_version(project_storage: str, commit_id: str, path: str) -> bytes:
+    """Returns the version of path that was replaced or deleted by commit_id."""
+    return read_stored_file(os.path.join(project_storage, ".history", commit_id, path))
+
+
+def blob_size(digest: str) -> int:
+    """Size of a blob's content, whether it is stored raw or packed."""
+    header = _read_pack_header(blob_path(digest))
+    if header and header["digest"] == digest:
+        return header["size"]
+    return os.path.getsize(blob_path(digest))
+
+
+def is_packed_blob(digest: str) -> bool:
+    """Whether a blob is stored packed and must be decoded before it is served."""
+    header = _read_pack_header(blob_path(digest))
+    return bool(header) and header["digest"] == digest
+
+
+def _unpack_blob(digest: str) -> None:
+    """Restores a packed blob to raw content so it can be hardlinked into a working tree."""
+    header = _read_pack_header(blob_path(digest))
+    if not header or header["digest"] != digest:
+        return
+
+    content = read_blob(digest)
+    tmp_path = new_temp_path()
+    with open(tmp_path, "wb") as f:
+        f.write(content)
+    os.replace(tmp_path, blob_path(digest))
+
+
+def compact_history_entry(history_path: str, base_digest: str | None = None) -> None:
+    """
+    Packs a superseded version according to HISTORY_ENCODING once no working
+    tree links to it any more. The object store and the history entry then
+    share the packed copy; deltas are taken against base_digest, the version
+    that replaced it, when both fit in DELTA_MAX_SIZE.
+    """
+    if HISTORY_ENCODING not in ("zlib", "delta"):
+        return
+    stat = os.stat(history_path)
+    if stat.st_size > PACK_MAX_SIZE:
+        return
+
+    with open(history_path, "rb") as f:
+        content = f.read()
+    if packing.parse_header(content[:packing.DELTA_HEADER_LENGTH]):
+        return
+
+    digest = hashlib.sha256(content).hexdigest()
+    with blob_lock(digest, exclusive=True):
+        _pack_history_entry(history_path, content, digest, base_digest)
+
+
+def _pack_history_entry(history_path: str, content: bytes, digest: str, base_digest: str | None) -> None:
+    stat = os.stat(history_path)
+    target = blob_path(digest)
+    stored_links = 2 if os.path.exists(target) and os.path.samefile(target, history_path) else 1
+    if stat.st_nlink > stored_links:
+        # Still checked out in a working tree (or shared with a fork or deployment)
+        return
+
+    use_delta = (
+        HISTORY_ENCODING == "delta" and base_digest and base_digest != digest
+        and stat.st_size <= DELTA_MAX_SIZE and blob_size(base_digest) <= DELTA_MAX_SIZE
+    )
+    if use_delta:
+        packed = packing.encode_delta(content, digest, read_blob(base_digest), base_digest)
+    else:
+        packed = packing.encode_zlib(content, digest)
+    if len(packed) >= len(content):
+        return
+
+    tmp_path = new_temp_path()
+    with open(tmp_path, "wb") as f:
+        f.write(packed)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    os.replace(tmp_path, target)
+    link_file(target, history_path)
+
+
+def backup_to_history(project_storage: str, commit_id: str, path: str) -> None:
+    """
+    Records the current version of a working tree file under .history/<commit_id>/.
+    The history entry is a hardlink, so no file content is copied.
+    """
+    backup_path = os.path.join(project_storage, ".history", commit_id, path)
+    link_file(os.path.join(project_storage, path), backup_path)
+
+
+def update_working_file(project_storage: str, commit_id: str, path: str, digest: str) -> None:
+    """Backs up the current version of path (if any) and checks out the new blob."""
+    file_path_full = os.path.join(project_storage, path)
+    had_previous = os.path.exists(file_path_full)
+    if had_previous:
+        backup_to_history(project_storage, commit_id, path)
+    checkout_blob(digest, file_path_full)
+    if had_previous:
+        compact_history_entry(os.path.join(project_storage, ".history", commit_id, path), digest)
+
+
+def remove_working_file(project_storage: str, commit_id: str, path: str) -> None:
+    """Moves a deleted file into .history/<commit_id>/, removing it from the current view."""
+    file_path_full = os.path.join(project_storage, path)
+    if os.path.exists(file_path_full):
+        backup_path = os.path.join(project_storage, ".history", commit_id, path)
+        os.makedirs(os.path.dirname(backup_path), exist_ok=True)
+        shutil.move(file_path_full, backup_path)
+        compact_history_entry(backup_path)
@@ -1,17 +1,41 @@
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.concurrency import run_in_threadpool
 from contextlib import asynccontextmanager
-from app.database import init_db, engine
+import asyncio
+from app.database import init_db, engine, async_engine
+from app.reaper import REAPER_INTERVAL, reap_deletions
+from app.blobs import sweep_blobs
+from app.consistency import CONSISTENCY_POLL_INTERVAL, run_consistency_check_if_due
 from app.routers import auth, repo, profile, pages
 
+async def run_periodically(job, interval: float) -> None:
+    """Runs a blocking background job every interval seconds, off the event loop."""
+    while True:
+        try:
+            await run_in_threadpool(job)
+        except Exception as e:
+            print(f"Error running {job.__name__}: {e}")
+        await asyncio.sleep(interval)
+
 # Lifespan context manager
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     print("Starting up...")
     init_db()
+    # Finishes queued repository deletions, including ones a restart interrupted
+    reaper = asyncio.create_task(run_periodically(reap_deletions, REAPER_INTERVAL))
+    # Each worker polls; the check itself runs on one worker per CONSISTENCY_INTERVAL
+    checker = asyncio.create_task(run_periodically(run_consistency_check_if_due, CONSISTENCY_POLL_INTERVAL))
+    # Removes blobs left unused by deletions, prunes and rejected pushes
+    sweeper = asyncio.create_task(run_periodically(sweep_blobs, REAPER_INTERVAL))
     yield
     print("Shutting down...")
+    reaper.cancel()
+    checker.cancel()
+    sweeper.cancel()
     engine.dispose()
+    await async_engine.dispose()
 
 # Create FastAPI app
 app = FastAPI(lifespan=lifespan)
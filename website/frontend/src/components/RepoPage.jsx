@@ -26,6 +26,7 @@ function RepoPage() {
     const [repoData, setRepoData] = useState(null);
     const [languages, setLanguages] = useState({});
     const [commits, setCommits] = useState([]);
+    const [commitsCursor, setCommitsCursor] = useState(null);
     const [loading, setLoading] = useState(true);
     const [error, setError] = useState(null);
     const [currentPath, setCurrentPath] = useState('');
@@ -71,6 +72,7 @@ function RepoPage() {
             if (commitRes.ok) {
                 const commitData = await commitRes.json();
                 setCommits(commitData.commits || []);
+                setCommitsCursor(commitData.next_cursor || null);
             }
 
         } catch (err) {
@@ -80,6 +82,18 @@ function RepoPage() {
         }
     };
 
+    const loadMoreCommits = async () => {
+        try {
+            const commitRes = await fetch(`${API_BASE_URL}/api/repo/${username}/${project_name}/commits?cursor=${encodeURIComponent(commitsCursor)}`);
+            if (!commitRes.ok) throw new Error("Failed to fetch commits");
+            const commitData = await commitRes.json();
+            setCommits(prev => [...prev, ...(commitData.commits || [])]);
+            setCommitsCursor(commitData.next_cursor || null);
+        } catch (err) {
+            console.error(err);
+        }
+    };
+
     const handleFileClick = async (path) => {
         try {
             setLoading(true);
@@ -493,6 +507,9 @@ function RepoPage() {
                         </div>
                     ))}
                     {commits.length === 0 && <p className="no_commits">No commits found.</p>}
+                    {commitsCursor && (
+                        <button onClick={loadMoreCommits} className="btn_secondary">Load more</button>
+                    )}
                 </div>
             )}
 